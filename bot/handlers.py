@@ -14,6 +14,34 @@ from bot.services import (
 
 logger = logging.getLogger(__name__)
 
+class StreamingReply:
+    """Mensagem do Telegram editada conforme a resposta do LLM chega em streaming"""
+    
+    def __init__(self, message):
+        self.message = message
+        self.sent = None
+        self.text = ""
+    
+    async def update(self, text: str):
+        """Envia o texto parcial (primeira chamada) ou edita a mensagem já enviada"""
+        if not text.strip() or text == self.text:
+            return
+        try:
+            if self.sent is None:
+                self.sent = await self.message.reply_text(text)
+            else:
+                await self.sent.edit_text(text)
+            self.text = text
+        except Exception as e:
+            logger.warning(f"Erro ao atualizar resposta parcial: {e}")
+    
+    async def finish(self, text: str):
+        """Garante que a mensagem final contenha a resposta completa"""
+        if self.sent is None:
+            await self.message.reply_text(text)
+        elif text != self.text:
+            await self.sent.edit_text(text)
+
 class MessageHandler:
     def __init__(self):
         self.whisper = WhisperService()
@@ -62,16 +90,19 @@ class MessageHandler:
                 await self._handle_level_test_response(update, context, user_message)
                 return
             
+            # Verificar gramática em paralelo com o "typing..."
+            grammar_task = asyncio.create_task(self.grammar.check_async(user_message))
+            
             # Mostrar "typing..."
             await context.bot.send_chat_action(
                 chat_id=chat_id,
                 action="typing"
             )
             
-            # Verificar gramática
-            grammar_errors = self.grammar.check(user_message)
+            grammar_errors = await grammar_task
             
-            # Gerar resposta com DeepSeek incluindo contexto histórico
+            # Gerar resposta com DeepSeek incluindo contexto histórico (em streaming)
+            reply = StreamingReply(update.message)
             response = await self.deepseek.generate_response(
                 user_message=user_message,
                 chat_id=chat_id,
@@ -80,13 +111,12 @@ class MessageHandler:
                 last_name=user.last_name,
                 user_level=user_level,
                 grammar_errors=grammar_errors,
-                is_voice=False
+                is_voice=False,
+                on_partial=reply.update
             )
             
             # Enviar resposta em texto (sem markdown para evitar erros)
-            await update.message.reply_text(
-                response['text']
-            )
+            await reply.finish(response['text'])
             
             # Se o modo incluir voz, gerar e enviar áudio
             if context.user_data.get('mode', 'both') in ['voice', 'both']:
@@ -101,19 +131,16 @@ class MessageHandler:
                 
                 # Gerar áudio apenas da parte em inglês
                 english_text = response.get('english_only', response['text'])
-                audio_path = await self.tts.generate_speech(english_text)
+                audio = await self.tts.generate_speech(english_text)
                 
                 # Deletar mensagem de status
                 await status_message.delete()
                 
-                if audio_path and os.path.exists(audio_path):
-                    with open(audio_path, 'rb') as audio_file:
-                        await update.message.reply_voice(
-                            voice=audio_file,
-                            caption="🔊 Listen to the pronunciation"
-                        )
-                    # Limpar arquivo temporário
-                    os.remove(audio_path)
+                if audio:
+                    await update.message.reply_voice(
+                        voice=audio,
+                        caption="🔊 Listen to the pronunciation"
+                    )
                     
         except Exception as e:
             logger.error(f"Erro ao processar texto: {e}")
@@ -146,6 +173,9 @@ class MessageHandler:
                 )
                 return
             
+            # Verificar gramática em paralelo com o envio da transcrição
+            grammar_task = asyncio.create_task(self.grammar.check_async(transcription))
+            
             # Enviar transcrição
             await update.message.reply_text(
                 f"📝 **I heard:** {transcription}"
@@ -156,10 +186,10 @@ class MessageHandler:
             user = update.effective_user
             user_level = context.user_data.get('level', 'B1')
             
-            # Verificar gramática
-            grammar_errors = self.grammar.check(transcription)
+            grammar_errors = await grammar_task
             
-            # Gerar resposta com contexto histórico
+            # Gerar resposta com contexto histórico (em streaming)
+            reply = StreamingReply(update.message)
             response = await self.deepseek.generate_response(
                 user_message=transcription,
                 chat_id=chat_id,
@@ -168,13 +198,12 @@ class MessageHandler:
                 last_name=user.last_name,
                 user_level=user_level,
                 grammar_errors=grammar_errors,
-                is_voice=True
+                is_voice=True,
+                on_partial=reply.update
             )
             
             # Enviar resposta em texto
-            await update.message.reply_text(
-                response['text']
-            )
+            await reply.finish(response['text'])
             
             # Gerar e enviar áudio da resposta
             # Mostrar que está gravando áudio
@@ -187,18 +216,16 @@ class MessageHandler:
             status_message = await update.message.reply_text("🎤 Recording audio response...")
             
             english_text = response.get('english_only', response['text'])
-            audio_path = await self.tts.generate_speech(english_text)
+            audio = await self.tts.generate_speech(english_text)
             
             # Deletar mensagem de status
             await status_message.delete()
             
-            if audio_path and os.path.exists(audio_path):
-                with open(audio_path, 'rb') as audio_file:
-                    await update.message.reply_voice(
-                        voice=audio_file,
-                        caption="🎯 Practice repeating this!"
-                    )
-                os.remove(audio_path)
+            if audio:
+                await update.message.reply_voice(
+                    voice=audio,
+                    caption="🎯 Practice repeating this!"
+                )
             
             # Limpar arquivo de voz original
             if os.path.exists(voice_path):
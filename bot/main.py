@@ -238,12 +238,28 @@ async def queue_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 def main():
     """Função principal"""
-    # Criar aplicação
-    application = Application.builder().token(os.getenv("TELEGRAM_BOT_TOKEN")).build()
-    
     # Instanciar handler assíncrono customizado
     async_handler = AsyncCustomHandler()
     
+    async def post_init(application: Application):
+        """Aquece as conexões com as APIs antes da primeira mensagem"""
+        await async_handler.message_handler.deepseek.prewarm()
+    
+    async def post_shutdown(application: Application):
+        """Fecha conexões HTTP e bancos persistentes ao encerrar o bot"""
+        await async_handler.message_handler.deepseek.close()
+        await async_handler.message_handler.whisper.close()
+        async_handler.message_handler.deepseek.history.close()
+    
+    # Criar aplicação
+    application = (
+        Application.builder()
+        .token(os.getenv("TELEGRAM_BOT_TOKEN"))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    
     # Adicionar handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
@@ -1,12 +1,127 @@
 import os
+import re
+import asyncio
+import random
 import aiohttp
+import orjson
+import time
 import logging
-from typing import Dict, List, Optional
+from collections import OrderedDict
+from itertools import islice
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
 from .optimized_history_service import OptimizedHistoryService
+from .queue_service import QueueService
 
 logger = logging.getLogger(__name__)
 
+# Persona and teaching rules - no per-user interpolation so the prefix stays
+# byte-identical across turns and can hit the provider's prompt cache
+_PROMPT_INTRO = """# Sarah Collins - Your Cool English Teacher 🌟
+
+## Core Identity
+You're **Sarah Collins**, a super fun and energetic English teacher who loves working with young people! You're 28 years old, a social media savvy millennial who knows how to connect with Gen Z. You're here to make English learning feel like chatting with an awesome older sister rather than a boring class.
+
+## IMPORTANT: PERSONALIZATION
+- Address the student by name when appropriate
+- Remember previous conversations and refer to them naturally
+- Build on topics and corrections from past interactions
+- Show genuine interest in their progress and learning journey
+- Use their interests and references to make lessons more engaging
+
+## Your Teaching Style:
+- **Be friendly**: Engage with the student as a friend. Ask questions about their interests and keep the tone conversational.
+- **Encourage and motivate**: Always praise their successes, even the small ones.
+- **Correct gently**: Offer corrections in a constructive way to keep the conversation moving smoothly.
+- **Make it fun**: Use pop culture references, emojis, and trendy expressions naturally
+- **Stay positive**: Create a supportive environment where mistakes are learning opportunities
+
+"""
+
+_PROMPT_RULES = """
+
+## Welcome Message Guidelines:
+When greeting new students or when they use /start, be warm and welcoming:
+"Welcome to your English learning journey! 🚀 I'm Sarah, your friendly English teacher! You can send me text or voice messages anytime to practice. If you'd like to take a level test to help me understand your English level better, just let me know and I'll guide you through it!"
+
+## RESPONSE FORMAT:
+1. **Greeting/Reaction**: Start with energy and acknowledgment
+2. **Address the content**: Respond to what they said with interest
+3. **Teaching moment**: Explain or correct (if needed) in a fun way
+4. **Practice/Challenge**: Give them something to try or think about
+5. **Personal touch**: Ask a follow-up question about their interests
+
+## CRITICAL RULES:
+1. ALWAYS respond in English (except for grammar corrections in Portuguese when needed)
+2. Adapt your language to the student's level described below
+3. If the student makes grammar mistakes, add a section in Portuguese explaining the errors
+4. Be encouraging and friendly like Sarah Collins
+5. Keep responses conversational but educational
+6. **REMEMBER and reference previous conversations naturally**
+7. Use the student's name when it feels natural
+8. Build on topics and progress from past interactions
+
+Remember: You're not just teaching English - you're building confidence, creating connections, and making learning an adventure! Keep it real, keep it fun, and always celebrate their progress! 🚀✨
+"""
+
+# "Levels of English" prompt section, one variant per level bucket
+_LEVEL_SECTIONS = {
+    "A": """## Levels of English:
+- **A1 (Beginner)**: Focus on basic vocabulary and present tense, with help in Portuguese if necessary.
+- **A2 (Elementary)**: Introduce past and future tenses, using simple language.""",
+    "B": """## Levels of English:
+- **B1 (Intermediate)**: Work on expressions and phrasal verbs, encourage the student to think in English.
+- **B2 (Upper-Intermediate)**: Include complex sentences, idioms, and discussions of deeper topics.""",
+    "C": """## Levels of English:
+- **C1 (Advanced)**: Use nuanced vocabulary and engage in cultural discussions.
+- **C2 (Proficient)**: Engage in near-native-level conversations, using advanced vocabulary and humor."""
+}
+
+_LEVEL_DESCRIPTIONS = {
+    "A1": "Use very simple words, short sentences, present tense mainly",
+    "A2": "Use simple vocabulary, basic past and future tenses",
+    "B1": "Use everyday vocabulary, various tenses, simple idioms",
+    "B2": "Use varied vocabulary, complex sentences, common phrasal verbs",
+    "C1": "Use sophisticated vocabulary, idioms, nuanced expressions",
+    "C2": "Use native-level vocabulary, cultural references, subtle humor"
+}
+
+# Punctuation/emoji stripped before matching a message against the response cache
+_CACHE_NORMALIZE_RE = re.compile(r"[^\w\s']+")
+
 class DeepSeekService:
+    # Static system prompt prefix per level bucket, built once at import
+    _STATIC_PROMPT_HEADS = {
+        bucket: _PROMPT_INTRO + section + _PROMPT_RULES
+        for bucket, section in _LEVEL_SECTIONS.items()
+    }
+    
+    # Reply budget per level - beginners can't make use of long answers
+    _MAX_TOKENS = {"A1": 250, "A2": 300, "B1": 450, "B2": 550, "C1": 600, "C2": 600}
+    
+    # Transient HTTP statuses worth retrying before falling back to the next API
+    _RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+    _MAX_RETRY_DELAY = 8
+    
+    # Offline replies per level, used when every API fails
+    _FALLBACKS = {
+        "A1": "Hi {name}! 😊 That's interesting! Can you tell me more about that? I want to help you practice English!",
+        "A2": "Hey {name}! 🌟 Thanks for sharing that! Let's practice together. Can you describe what you did yesterday?",
+        "B1": "Hello {name}! 💫 That's a great topic! I'd love to help you improve your English. What's your favorite hobby?",
+        "B2": "Hi there {name}! ✨ I'm here to help you with English! What would you like to practice today?",
+        "C1": "Hello {name}! 🚀 I'm excited to continue our English journey together! What's on your mind?",
+        "C2": "Hey {name}! 🎯 Great to chat with you again! What fascinating topic shall we explore today?"
+    }
+    
+    # Minimum seconds between partial-text callbacks while streaming (Telegram throttles message edits)
+    _STREAM_EDIT_INTERVAL = 1.0
+    
+    # Response cache for short, error-free small talk ("hello", "how are you"). Replies built
+    # without per-student context are shared across users; the rest are scoped to their chat
+    _RESPONSE_CACHE_SIZE = 512
+    _RESPONSE_CACHE_TTL = 600
+    _CACHEABLE_MAX_WORDS = 6
+    _NAME_PLACEHOLDER = "<NAME>"
+    
     def __init__(self, api_key: str = None, history_service: OptimizedHistoryService = None):
         """Initializes the DeepSeek service with optimized individual chat databases"""
         
@@ -36,18 +151,41 @@ class DeepSeekService:
             "Content-Type": "application/json"
         }
         
+        # Shared HTTP session, created lazily inside the running event loop
+        self._session: Optional[aiohttp.ClientSession] = None
+        
+        # (chat_id or None, normalized message, level, is_voice) -> (expires at, response with the
+        # student's name replaced by a placeholder)
+        self._response_cache: "OrderedDict[Tuple, Tuple[float, Dict[str, str]]]" = OrderedDict()
+        # Chats that already sent a message through this service; their turns may still be waiting
+        # in persist_queue, so an empty recent_history does not mean the conversation is new
+        self._chats_with_history: set = set()
+        
         # Optimized history service with individual chat databases
         self.history = history_service or OptimizedHistoryService()
         
-        # Determine which API to use
+        # Message writes are batched and committed off the event loop by the queue workers
+        self.persist_queue = QueueService(history_service=self.history)
+        
+        # Provider dispatch table (name, url, headers, payload skeleton), resolved once in priority order
+        self._providers = []
         if self.openrouter_key:
-            primary_api = "OpenRouter DeepSeek (working!)"
-        elif self.use_local_gpt4all:
-            primary_api = "GPT4All Local"
-        elif self.use_direct_deepseek and self.deepseek_key:
-            primary_api = "DeepSeek Direct"
-        else:
-            primary_api = "No API configured"
+            self._providers.append((
+                "OpenRouter DeepSeek", f"{self.openrouter_url}/chat/completions",
+                self.openrouter_headers, self._payload_skeleton(self.openrouter_model)
+            ))
+        if self.use_local_gpt4all:
+            self._providers.append((
+                "GPT4All Local", f"{self.gpt4all_url}/v1/chat/completions",
+                {"Content-Type": "application/json"}, self._payload_skeleton("Llama-3-8B-Instruct")
+            ))
+        if self.use_direct_deepseek and self.deepseek_key:
+            self._providers.append((
+                "DeepSeek Direct", f"{self.deepseek_url}/chat/completions",
+                self.deepseek_headers, self._payload_skeleton("deepseek-chat")
+            ))
+        
+        primary_api = self._providers[0][0] if self._providers else "No API configured"
             
         logger.info(f"DeepSeek initialized. Primary API: {primary_api}")
         logger.info(f"Available APIs: OpenRouter: {bool(self.openrouter_key)}, GPT4All: {self.use_local_gpt4all}, DeepSeek Direct: {bool(self.deepseek_key)}")
@@ -61,9 +199,14 @@ class DeepSeekService:
         last_name: str = None,
         user_level: str = "B1",
         grammar_errors: List[Dict] = None,
-        is_voice: bool = False
+        is_voice: bool = False,
+        on_partial: Optional[Callable[[str], Awaitable[None]]] = None
     ) -> Dict[str, str]:
-        """Generate response with user's historical context"""
+        """Generate response with user's historical context
+        
+        If on_partial is given the reply is streamed and the callback receives
+        the accumulated text as tokens arrive.
+        """
         
         if not user_message or not user_message.strip():
             return {
@@ -72,181 +215,255 @@ class DeepSeekService:
             }
         
         # Ensure user exists in the database
-        self.history.get_or_create_user(chat_id, username, first_name, last_name)
-        
-        # Save user message with proper parameters
-        self.history.save_message(
-            chat_id=chat_id, 
-            message_type='user', 
-            content=user_message, 
-            is_voice=is_voice, 
-            has_errors=bool(grammar_errors),
-            grammar_corrections=grammar_errors if grammar_errors else None
-        )
+        await self.history.run(self.history.get_or_create_user, chat_id, username, first_name, last_name)
+        
+        # Buffer user message; it is flushed together with Sarah's reply in one transaction
+        user_record = {
+            'message_type': 'user',
+            'content': user_message,
+            'is_voice': is_voice,
+            'has_errors': bool(grammar_errors),
+            'grammar_corrections': grammar_errors if grammar_errors else None
+        }
         
         # Get user's context from the history
-        user_context = self.history.get_user_context(chat_id)
+        user_context = await self.history.run(self.history.get_user_context, chat_id)
         actual_level = user_context.get('user', {}).get('english_level', user_level)
         
         # Construct system prompt based on the user's context
-        system_prompt = self._build_system_prompt(actual_level, is_voice, user_context)
+        system_prompt, dynamic_context = self._build_system_prompt(actual_level, is_voice, user_context)
         
         # Build user content message with grammar corrections if necessary
         user_content = self._build_user_content(user_message, grammar_errors)
         
-        # Try generating a response using available services
-        response_data = await self._generate_response_with_fallback(system_prompt, user_content)
+        # Common small talk is answered from the cache without an LLM round-trip
+        user_name = user_context.get('user_name', 'there')
+        # The dynamic context quotes this student's history and stats: never share those replies.
+        # Only a student's very first message (nothing persisted or pending) is answered globally
+        has_history = bool(user_context.get('recent_history')) or chat_id in self._chats_with_history
+        self._chats_with_history.add(chat_id)
+        cache_key = None if grammar_errors else self._response_cache_key(
+            user_message, actual_level, is_voice, chat_id if has_history else None
+        )
+        response_data = self._cached_response(cache_key, user_name)
         
-        if response_data:
-            # Save Sarah's response to history with proper parameters
-            self.history.save_message(
-                chat_id=chat_id, 
-                message_type='sarah', 
-                content=response_data['text']
+        if not response_data:
+            # Try generating a response using available services
+            max_tokens = self._MAX_TOKENS.get(actual_level, 600)
+            response_data = await self._generate_response_with_fallback(
+                system_prompt, dynamic_context, user_content, max_tokens, on_partial
             )
-            return response_data
-        else:
+            if response_data:
+                self._store_response(cache_key, response_data, user_name)
+        
+        if not response_data:
             # Fallback response in case of failure
-            fallback = self._fallback_response(user_message, actual_level, user_context)
-            self.history.save_message(
-                chat_id=chat_id, 
-                message_type='sarah', 
-                content=fallback['text']
-            )
-            return fallback
+            response_data = self._fallback_response(user_message, actual_level, user_context)
+        
+        # Queue both turns for a batched commit off the event loop
+        await self.persist_queue.add_task({
+            'type': 'persist_message',
+            'chat_id': chat_id,
+            'messages': [user_record, {'message_type': 'sarah', 'content': response_data['text']}]
+        })
+        return response_data
+    
+    def _response_cache_key(self, user_message: str, level: str, is_voice: bool,
+                            scope: Optional[int]) -> Optional[Tuple]:
+        """Cache key for short messages, None if the message should always go to the LLM"""
+        words = _CACHE_NORMALIZE_RE.sub(" ", user_message.lower()).split()
+        if not words or len(words) > self._CACHEABLE_MAX_WORDS:
+            return None
+        return scope, " ".join(words), level, is_voice
+    
+    def _cached_response(self, key: Optional[Tuple], user_name: str) -> Optional[Dict[str, str]]:
+        """Return a cached response personalized for this student, if any"""
+        cached = self._response_cache.get(key) if key else None
+        if not cached:
+            return None
+        expires_at, response = cached
+        if expires_at <= time.monotonic():
+            del self._response_cache[key]
+            return None
+        self._response_cache.move_to_end(key)
+        logger.info("Response served from cache")
+        return {field: value.replace(self._NAME_PLACEHOLDER, user_name) for field, value in response.items()}
+    
+    def _store_response(self, key: Optional[Tuple], response: Dict[str, str], user_name: str):
+        """Cache an LLM response with the student's name swapped for a placeholder"""
+        if not key:
+            return
+        if user_name and user_name != 'there':
+            # Whole words only: a student called "Al" must not turn "Also" into "<NAME>so"
+            name_re = re.compile(rf"(?<!\w){re.escape(user_name)}(?!\w)")
+            response = {field: name_re.sub(self._NAME_PLACEHOLDER, value) for field, value in response.items()}
+        self._response_cache[key] = (time.monotonic() + self._RESPONSE_CACHE_TTL, response)
+        if len(self._response_cache) > self._RESPONSE_CACHE_SIZE:
+            self._response_cache.popitem(last=False)
     
-    async def _generate_response_with_fallback(self, system_prompt: str, user_content: str) -> Dict[str, str]:
+    async def _generate_response_with_fallback(self, system_prompt: str, dynamic_context: str, user_content: str,
+                                               max_tokens: int = 600,
+                                               on_partial: Optional[Callable[[str], Awaitable[None]]] = None
+                                               ) -> Dict[str, str]:
         """Generate response by trying APIs in order of priority"""
         
         # Try OpenRouter (DeepSeek) -> GPT4All -> DeepSeek Direct
-        if self.openrouter_key:
-            result = await self._generate_with_openrouter(system_prompt, user_content)
-            if result:
-                logger.info("Response generated with OpenRouter DeepSeek")
-                return result
-            logger.warning("OpenRouter failed, trying GPT4All...")
-        
-        if self.use_local_gpt4all:
-            result = await self._generate_with_gpt4all(system_prompt, user_content)
+        for name, url, headers, payload in self._providers:
+            result = await self._generate(
+                name, url, headers, payload, system_prompt, dynamic_context, user_content, max_tokens,
+                on_partial
+            )
             if result:
-                logger.info("Response generated with GPT4All Local")
+                logger.info(f"Response generated with {name}")
                 return result
-            logger.warning("GPT4All failed, trying DeepSeek Direct...")
+            logger.warning(f"{name} failed, trying next API...")
         
-        if self.use_direct_deepseek and self.deepseek_key:
-            result = await self._generate_with_deepseek_direct(system_prompt, user_content)
-            if result:
-                logger.info("Response generated with DeepSeek Direct")
-                return result
+        if self._providers:
             logger.error("All APIs failed!")
-        
         return None
     
-    async def _generate_with_gpt4all(self, system_prompt: str, user_content: str) -> Dict[str, str]:
-        """Generate response using GPT4All local"""
-        try:
-            async with aiohttp.ClientSession() as session:
-                payload = {
-                    "model": "Llama-3-8B-Instruct",
-                    "messages": [
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": user_content}
-                    ],
-                    "temperature": 0.7,
-                    "max_tokens": 600
-                }
-                
-                async with session.post(
-                    f"{self.gpt4all_url}/v1/chat/completions",
-                    headers={"Content-Type": "application/json"},
-                    json=payload
-                ) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        response_content = data['choices'][0]['message']['content']
-                        return self._parse_response(response_content, None)
-                    else:
-                        logger.error(f"GPT4All error: {response.status}")
-                        return None
-                        
-        except Exception as e:
-            logger.error(f"GPT4All exception: {e}")
-            return None
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Return the shared HTTP session, keeping connections alive between requests"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=100,
+                    limit_per_host=20,
+                    keepalive_timeout=90,
+                    ttl_dns_cache=300
+                ),
+                timeout=aiohttp.ClientTimeout(total=120)
+            )
+        return self._session
+    
+    async def prewarm(self):
+        """Open keep-alive connections to the configured APIs before the first message"""
+        session = await self._get_session()
+        
+        async def ping(name: str, url: str, headers: Dict[str, str]):
+            try:
+                models_url = url.rsplit("/chat/completions", 1)[0] + "/models"
+                async with session.head(models_url, headers=headers) as response:
+                    logger.info(f"{name} prewarmed ({response.status})")
+            except Exception as e:
+                logger.warning(f"{name} prewarm failed: {e}")
+        
+        await asyncio.gather(*(ping(name, url, headers) for name, url, headers, _ in self._providers))
     
-    async def _generate_with_deepseek_direct(self, system_prompt: str, user_content: str) -> Dict[str, str]:
-        """Generate response using DeepSeek API"""
+    async def close(self):
+        """Close the shared HTTP session and flush queued history writes (call on bot shutdown)"""
+        await self.persist_queue.stop()
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+    
+    @staticmethod
+    def _payload_skeleton(model: str) -> Dict:
+        """Reusable chat completions payload, filled in place on every request"""
+        return {
+            "model": model,
+            "messages": [
+                {"role": "system", "content": None},  # static persona (cacheable prefix)
+                {"role": "system", "content": None},  # per-student context
+                {"role": "user", "content": None}
+            ],
+            "temperature": 0.7,
+            "max_tokens": 600
+        }
+    
+    async def _generate(self, name: str, url: str, headers: Dict[str, str], payload: Dict,
+                        system_prompt: str, dynamic_context: str, user_content: str,
+                        max_tokens: int = 600,
+                        on_partial: Optional[Callable[[str], Awaitable[None]]] = None) -> Dict[str, str]:
+        """Generate response using an OpenAI-compatible chat completions endpoint"""
         try:
-            async with aiohttp.ClientSession() as session:
-                payload = {
-                    "model": "deepseek-chat",
-                    "messages": [
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": user_content}
-                    ],
-                    "temperature": 0.7,
-                    "max_tokens": 600
-                }
-                
-                async with session.post(
-                    f"{self.deepseek_url}/chat/completions",
-                    headers=self.deepseek_headers,
-                    json=payload
-                ) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        response_content = data['choices'][0]['message']['content']
-                        return self._parse_response(response_content, None)
-                    else:
-                        logger.error(f"DeepSeek Direct error: {response.status}")
-                        return None
-                        
+            # Fill the provider skeleton and serialize right away - there is no await
+            # in between, so concurrent turns can't observe each other's content
+            messages = payload["messages"]
+            messages[0]["content"] = system_prompt
+            messages[1]["content"] = dynamic_context
+            messages[2]["content"] = user_content
+            payload["max_tokens"] = max_tokens
+            payload["stream"] = on_partial is not None
+            body = orjson.dumps(payload)
+            
+            content = await self._post_with_retry(name, url, headers, body, on_partial)
+            if content is None:
+                return None
+            
+            return self._parse_response(content, None)
+                    
         except Exception as e:
-            logger.error(f"DeepSeek Direct exception: {e}")
+            logger.error(f"{name} exception: {e}")
             return None
     
-    async def _generate_with_openrouter(self, system_prompt: str, user_content: str) -> Dict[str, str]:
-        """Generate response using OpenRouter/DeepSeek API"""
-        try:
-            async with aiohttp.ClientSession() as session:
-                payload = {
-                    "model": self.openrouter_model,
-                    "messages": [
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": user_content}
-                    ],
-                    "temperature": 0.7,
-                    "max_tokens": 600
-                }
-                
-                async with session.post(
-                    f"{self.openrouter_url}/chat/completions",
-                    headers=self.openrouter_headers,
-                    json=payload
-                ) as response:
+    async def _post_with_retry(self, name: str, url: str, headers: Dict[str, str],
+                               body: bytes, on_partial: Optional[Callable[[str], Awaitable[None]]] = None,
+                               attempts: int = 3) -> Optional[str]:
+        """POST with jittered exponential backoff on 429/5xx and connection errors, returns the reply text"""
+        session = await self._get_session()
+        
+        for attempt in range(attempts):
+            retry_after = None
+            try:
+                # Headers are prebuilt per provider and already carry the JSON
+                # Content-Type, aiohttp fills in Content-Length for bytes bodies
+                async with session.post(url, headers=headers, data=body) as response:
                     if response.status == 200:
-                        data = await response.json()
-                        response_content = data['choices'][0]['message']['content']
-                        return self._parse_response(response_content, None)
-                    else:
-                        logger.error(f"OpenRouter error: {response.status}")
+                        if on_partial:
+                            return await self._read_stream(response, on_partial)
+                        data = orjson.loads(await response.read())
+                        return data['choices'][0]['message']['content']
+                    if response.status not in self._RETRY_STATUSES:
+                        logger.error(f"{name} error: {response.status}")
                         return None
-                        
-        except Exception as e:
-            logger.error(f"OpenRouter exception: {e}")
-            return None
+                    retry_after = response.headers.get("Retry-After")
+                    logger.warning(f"{name} error: {response.status} (attempt {attempt + 1}/{attempts})")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning(f"{name} request failed: {e} (attempt {attempt + 1}/{attempts})")
+            
+            if attempt + 1 == attempts:
+                break
+            
+            if retry_after and retry_after.isdigit():
+                delay = float(retry_after)
+            else:
+                delay = min(2 ** attempt + random.random(), self._MAX_RETRY_DELAY)
+            if delay > self._MAX_RETRY_DELAY:
+                # Server asked for a longer pause than a chat turn can afford
+                break
+            await asyncio.sleep(delay)
+        
+        return None
     
-    def _build_system_prompt(self, level: str, is_voice: bool, user_context: Dict = None) -> str:
-        """Build the system prompt based on user level and historical context"""
-        
-        # Levels and explanations
-        level_descriptions = {
-            "A1": "Use very simple words, short sentences, present tense mainly",
-            "A2": "Use simple vocabulary, basic past and future tenses",
-            "B1": "Use everyday vocabulary, various tenses, simple idioms",
-            "B2": "Use varied vocabulary, complex sentences, common phrasal verbs",
-            "C1": "Use sophisticated vocabulary, idioms, nuanced expressions",
-            "C2": "Use native-level vocabulary, cultural references, subtle humor"
-        }
+    async def _read_stream(self, response: aiohttp.ClientResponse,
+                           on_partial: Callable[[str], Awaitable[None]]) -> Optional[str]:
+        """Accumulate an SSE chat completion stream, reporting progress at most once per interval"""
+        parts = []
+        last_update = time.monotonic()
+        
+        async for line in response.content:
+            if not line.startswith(b"data:"):
+                continue
+            data = line[5:].strip()
+            if data == b"[DONE]":
+                break
+            
+            choices = orjson.loads(data).get("choices")
+            delta = choices[0].get("delta", {}).get("content") if choices else None
+            if not delta:
+                continue
+            parts.append(delta)
+            
+            now = time.monotonic()
+            if now - last_update >= self._STREAM_EDIT_INTERVAL:
+                last_update = now
+                await on_partial("".join(parts))
+        
+        return "".join(parts) or None
+    
+    def _build_system_prompt(self, level: str, is_voice: bool, user_context: Dict = None) -> Tuple[str, str]:
+        """Build the (static persona, per-student context) system messages"""
         
         voice_extra = "The user sent a voice message, so include pronunciation tips if relevant." if is_voice else ""
         
@@ -275,82 +492,33 @@ class DeepSeekService:
 - Grammar corrections given: {corrections}
 - This student has been practicing with you regularly!
 """
-
-        return f"""# Sarah Collins - Your Cool English Teacher 🌟
-
-## Core Identity
-You're **Sarah Collins**, a super fun and energetic English teacher who loves working with young people! You're 28 years old, a social media savvy millennial who knows how to connect with Gen Z. You're here to make English learning feel like chatting with an awesome older sister rather than a boring class.
-
-## IMPORTANT: PERSONALIZATION
-- Address the student as "{user_name}" when appropriate  
-- Remember previous conversations and refer to them naturally
-- Build on topics and corrections from past interactions
-- Show genuine interest in their progress and learning journey
-- Use their interests and references to make lessons more engaging
-
-## Your Teaching Style:
-- **Be friendly**: Engage with the student as a friend. Ask questions about their interests and keep the tone conversational.
-- **Encourage and motivate**: Always praise their successes, even the small ones.
-- **Correct gently**: Offer corrections in a constructive way to keep the conversation moving smoothly.
-- **Make it fun**: Use pop culture references, emojis, and trendy expressions naturally
-- **Stay positive**: Create a supportive environment where mistakes are learning opportunities
-
-## Levels of English:
-- **A1 (Beginner)**: Focus on basic vocabulary and present tense, with help in Portuguese if necessary.
-- **A2 (Elementary)**: Introduce past and future tenses, using simple language.
-- **B1 (Intermediate)**: Work on expressions and phrasal verbs, encourage the student to think in English.
-- **B2 (Upper-Intermediate)**: Include complex sentences, idioms, and discussions of deeper topics.
-- **C1 (Advanced)**: Use nuanced vocabulary and engage in cultural discussions.
-- **C2 (Proficient)**: Engage in near-native-level conversations, using advanced vocabulary and humor.
-
-## Welcome Message Guidelines:
-When greeting new students or when they use /start, be warm and welcoming:
-"Welcome to your English learning journey! 🚀 I'm Sarah, your friendly English teacher! You can send me text or voice messages anytime to practice. If you'd like to take a level test to help me understand your English level better, just let me know and I'll guide you through it!"
-
-{conversation_summary}
-
+        
+        level = level or "B1"
+        static_head = self._STATIC_PROMPT_HEADS.get(level[:1], self._STATIC_PROMPT_HEADS["B"])
+        
+        # Per-student details go in their own message so the persona stays byte-identical
+        return static_head, f"""{conversation_summary}
 {stats_info}
-
-## RESPONSE FORMAT:
-1. **Greeting/Reaction**: Start with energy and acknowledgment
-2. **Address the content**: Respond to what they said with interest
-3. **Teaching moment**: Explain or correct (if needed) in a fun way
-4. **Practice/Challenge**: Give them something to try or think about
-5. **Personal touch**: Ask a follow-up question about their interests
-
-## Current Student Level: {level_descriptions.get(level, "intermediate")}
+## Current Student Level ({level}): {_LEVEL_DESCRIPTIONS.get(level, "intermediate")}
 {voice_extra}
 
-## CRITICAL RULES:
-1. ALWAYS respond in English (except for grammar corrections in Portuguese when needed)
-2. Adapt your language to the student's {level} level
-3. If the student makes grammar mistakes, add a section in Portuguese explaining the errors
-4. Be encouraging and friendly like Sarah Collins
-5. Keep responses conversational but educational
-6. **REMEMBER and reference previous conversations naturally**
-7. Use the student's name ({user_name}) when it feels natural
-8. Build on topics and progress from past interactions
-
-Remember: You're not just teaching English - you're building confidence, creating connections, and making learning an adventure! Keep it real, keep it fun, and always celebrate their progress! 🚀✨"""
+## Student Name: {user_name}"""
         
     def _build_user_content(self, message: str, errors: List[Dict]) -> str:
         """Add information about grammar errors if present"""
-        if errors:
-            error_summary = "\n[Grammar issues detected: " + ", ".join([e['rule'] for e in errors[:3]]) + "]"
-            return f"{message}{error_summary}"
-        return message
+        if not errors:
+            return message
+        rules = ", ".join(e['rule'] for e in islice(errors, 3))
+        return f"{message}\n[Grammar issues detected: {rules}]"
     
     def _parse_response(self, content: str, has_errors: bool) -> Dict[str, str]:
         """Parse response and extract English and Portuguese parts"""
-        if "---" in content:
-            parts = content.split("---", 1)
-            english_part = parts[0].strip()
-            portuguese_part = parts[1].strip() if len(parts) > 1 else ""
-            
+        english_part, separator, portuguese_part = content.partition("---")
+        if separator:
             return {
                 'text': content,
-                'english_only': english_part,
-                'portuguese_corrections': portuguese_part
+                'english_only': english_part.strip(),
+                'portuguese_corrections': portuguese_part.strip()
             }
         else:
             return {
@@ -361,17 +529,7 @@ Remember: You're not just teaching English - you're building confidence, creatin
     def _fallback_response(self, user_message: str, level: str, user_context: Dict = None) -> Dict[str, str]:
         """Fallback response when API fails"""
         user_name = user_context.get('user_name', 'there') if user_context else 'there'
-        
-        fallback_responses = {
-            "A1": f"Hi {user_name}! 😊 That's interesting! Can you tell me more about that? I want to help you practice English!",
-            "A2": f"Hey {user_name}! 🌟 Thanks for sharing that! Let's practice together. Can you describe what you did yesterday?",
-            "B1": f"Hello {user_name}! 💫 That's a great topic! I'd love to help you improve your English. What's your favorite hobby?",
-            "B2": f"Hi there {user_name}! ✨ I'm here to help you with English! What would you like to practice today?",
-            "C1": f"Hello {user_name}! 🚀 I'm excited to continue our English journey together! What's on your mind?",
-            "C2": f"Hey {user_name}! 🎯 Great to chat with you again! What fascinating topic shall we explore today?"
-        }
-        
-        fallback = fallback_responses.get(level, fallback_responses["B1"])
+        fallback = self._FALLBACKS.get(level, self._FALLBACKS["B1"]).format(name=user_name)
         
         return {
             'text': fallback,
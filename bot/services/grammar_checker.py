@@ -1,4 +1,5 @@
 import language_tool_python
+import asyncio
 import re
 from typing import List, Dict
 
@@ -25,6 +26,15 @@ class GrammarChecker:
                 'rule': 'Use "there are" for existence, not just "are"'
             }
         ]
+        
+        # Compilar todos os padrões numa única alternação (uma passada pelo texto)
+        self._combined_pattern = re.compile(
+            "|".join(
+                f"(?P<r{i}>{error_rule['pattern']})"
+                for i, error_rule in enumerate(self.brazilian_common_errors)
+            ),
+            re.IGNORECASE
+        )
     
     def check(self, text: str) -> List[Dict]:
         """Verifica erros gramaticais no texto"""
@@ -49,17 +59,29 @@ class GrammarChecker:
             })
         
         # Verificar erros comuns de brasileiros
-        for error_rule in self.brazilian_common_errors:
-            if re.search(error_rule['pattern'], text, re.IGNORECASE):
-                errors.append({
-                    'rule': error_rule['rule'],
-                    'category': 'Brazilian Common Error',
-                    'correct': error_rule['correct'],
-                    'suggestions': [error_rule['correct']]
-                })
+        # Primeira ocorrência de cada regra (o trecho vai para a tabela corrections)
+        matched_rules = {}
+        for m in self._combined_pattern.finditer(text):
+            matched_rules.setdefault(int(m.lastgroup[1:]), m)
+        for i in sorted(matched_rules):
+            error_rule = self.brazilian_common_errors[i]
+            match = matched_rules[i]
+            errors.append({
+                'rule': error_rule['rule'],
+                'category': 'Brazilian Common Error',
+                'offset': match.start(),
+                'length': match.end() - match.start(),
+                'correct': error_rule['correct'],
+                'suggestions': [error_rule['correct']],
+                'original': match.group()
+            })
         
         return errors
     
+    async def check_async(self, text: str) -> List[Dict]:
+        """Executa check() numa thread para não bloquear o event loop"""
+        return await asyncio.to_thread(self.check, text)
+    
     def format_corrections_portuguese(self, errors: List[Dict]) -> str:
         """Formata correções em português"""
         if not errors:
@@ -1,22 +1,132 @@
 import sqlite3
-import json
+import orjson
 import logging
+import threading
+import time
+import copy
+from collections import OrderedDict
 from datetime import datetime
 from typing import Dict, List, Optional, Tuple
 from pathlib import Path
 
 logger = logging.getLogger(__name__)
 
+# Colunas de users/user_preferences, usadas para separar o resultado do JOIN em get_user_context
+_USER_COLUMNS = ('chat_id', 'username', 'first_name', 'last_name', 'english_level', 'created_at', 'last_active')
+_PREFERENCE_COLUMNS = ('topics_of_interest', 'learning_goals', 'preferred_response_style', 'session_count')
+
+# Contadores mantidos em user_preferences a cada save_message (evita agregar conversations por turno)
+_STATS_COLUMNS = ('total_messages', 'user_messages', 'messages_with_errors', 'voice_messages')
+
+# Últimas mensagens mantidas no resumo incremental (user_preferences.conversation_summary_cached)
+_SUMMARY_LINES = 4
+
+
+def _summary_line(message_type: str, content: str) -> str:
+    """Formata uma mensagem como linha do resumo da conversa"""
+    role = "Student" if message_type == 'user' else "Sarah"
+    content = content[:100] + "..." if len(content) > 100 else content
+    return f"- {role}: {content}"
+
+
+# Cache em memória de get_user_context: validade (segundos) e número máximo de chats
+_CONTEXT_TTL = 30
+_CONTEXT_CACHE_SIZE = 10000
+
+# SQL do caminho quente, definido uma vez para reaproveitar o cache de statements do sqlite3
+_SQL_GET_USER = "SELECT * FROM users WHERE chat_id = ?"
+_SQL_TOUCH_USER = "UPDATE users SET last_active = CURRENT_TIMESTAMP WHERE chat_id = ?"
+_SQL_INSERT_USER = """
+    INSERT INTO users (chat_id, username, first_name, last_name)
+    VALUES (?, ?, ?, ?)
+"""
+_SQL_INSERT_PREFERENCES = """
+    INSERT INTO user_preferences (chat_id, topics_of_interest, session_count)
+    VALUES (?, ?, 1)
+"""
+_SQL_INSERT_CONVERSATION = """
+    INSERT INTO conversations 
+    (chat_id, message_type, content, is_voice, has_errors, grammar_corrections)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+_SQL_INCREMENT_STATS = """
+    UPDATE user_preferences SET
+        total_messages = total_messages + 1,
+        user_messages = user_messages + ?,
+        messages_with_errors = messages_with_errors + ?,
+        voice_messages = voice_messages + ?
+    WHERE chat_id = ?
+"""
+_SQL_RECENT_HISTORY = """
+    SELECT * FROM conversations 
+    WHERE chat_id = ? 
+    ORDER BY timestamp DESC 
+    LIMIT ?
+"""
+_SQL_UPDATE_LEVEL = "UPDATE users SET english_level = ? WHERE chat_id = ?"
+_SQL_USER_CONTEXT = """
+    SELECT u.*, p.chat_id AS pref_chat_id, p.topics_of_interest, p.learning_goals,
+           p.preferred_response_style, p.session_count, p.total_messages,
+           p.user_messages, p.messages_with_errors, p.voice_messages
+    FROM users u LEFT JOIN user_preferences p ON p.chat_id = u.chat_id
+    WHERE u.chat_id = ?
+"""
+_SQL_INCREMENT_SESSIONS = """
+    UPDATE user_preferences 
+    SET session_count = session_count + 1 
+    WHERE chat_id = ?
+"""
+_SQL_GET_TOPICS = "SELECT topics_of_interest FROM user_preferences WHERE chat_id = ?"
+_SQL_SET_TOPICS = """
+    UPDATE user_preferences 
+    SET topics_of_interest = ? 
+    WHERE chat_id = ?
+"""
+_SQL_GET_SUMMARY = "SELECT conversation_summary_cached FROM user_preferences WHERE chat_id = ?"
+_SQL_SET_SUMMARY = """
+    UPDATE user_preferences 
+    SET conversation_summary_cached = ?, summary_updated_ts = CURRENT_TIMESTAMP 
+    WHERE chat_id = ?
+"""
+_SQL_HAS_HISTORY = "SELECT EXISTS(SELECT 1 FROM conversations WHERE chat_id = ? LIMIT 1)"
+_SQL_SUMMARY_USER = """
+    SELECT u.first_name, u.english_level, p.total_messages, p.conversation_summary_cached
+    FROM users u LEFT JOIN user_preferences p ON p.chat_id = u.chat_id
+    WHERE u.chat_id = ?
+"""
+
 class HistoryService:
     def __init__(self, db_path: str = "data/user_history.db"):
         """Inicializa o serviço de histórico com banco SQLite"""
         self.db_path = Path(db_path)
         self.db_path.parent.mkdir(exist_ok=True)
+        
+        # Conexão única e persistente (autocommit) compartilhada por todos os métodos
+        self._conn = sqlite3.connect(
+            self.db_path, check_same_thread=False, isolation_level=None, cached_statements=256
+        )
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA temp_store=MEMORY")
+        self._conn.execute("PRAGMA mmap_size=67108864")
+        self._conn.execute("PRAGMA cache_size=-20000")
+        self._lock = threading.RLock()
+        
+        # chat_id -> (instante da leitura, contexto); invalidado a cada escrita do chat
+        self._ctx_cache: "OrderedDict[int, Tuple[float, Dict]]" = OrderedDict()
+        
         self._init_database()
     
+    def close(self):
+        """Fecha a conexão com o banco"""
+        with self._lock:
+            self._conn.close()
+    
     def _init_database(self):
         """Cria as tabelas necessárias no banco"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._lock:
+            conn = self._conn
             conn.execute("""
                 CREATE TABLE IF NOT EXISTS users (
                     chat_id INTEGER PRIMARY KEY,
@@ -50,45 +160,70 @@ class HistoryService:
                     learning_goals TEXT,
                     preferred_response_style TEXT,
                     session_count INTEGER DEFAULT 0,
+                    total_messages INTEGER DEFAULT 0,
+                    user_messages INTEGER DEFAULT 0,
+                    messages_with_errors INTEGER DEFAULT 0,
+                    voice_messages INTEGER DEFAULT 0,
+                    conversation_summary_cached TEXT,  -- JSON array com as últimas linhas do resumo
+                    summary_updated_ts TIMESTAMP,
                     FOREIGN KEY (chat_id) REFERENCES users (chat_id)
                 )
             """)
             
-            conn.commit()
+            # Bancos antigos: adiciona os contadores e preenche a partir do histórico existente
+            existing = {row['name'] for row in conn.execute("PRAGMA table_info(user_preferences)")}
+            missing = [column for column in _STATS_COLUMNS if column not in existing]
+            if missing:
+                for column in missing:
+                    conn.execute(f"ALTER TABLE user_preferences ADD COLUMN {column} INTEGER DEFAULT 0")
+                conn.execute("""
+                    UPDATE user_preferences SET
+                        total_messages = (SELECT COUNT(*) FROM conversations c
+                                          WHERE c.chat_id = user_preferences.chat_id),
+                        user_messages = (SELECT COUNT(*) FROM conversations c
+                                         WHERE c.chat_id = user_preferences.chat_id AND c.message_type = 'user'),
+                        messages_with_errors = (SELECT COUNT(*) FROM conversations c
+                                                WHERE c.chat_id = user_preferences.chat_id AND c.has_errors = 1),
+                        voice_messages = (SELECT COUNT(*) FROM conversations c
+                                          WHERE c.chat_id = user_preferences.chat_id AND c.is_voice = 1)
+                """)
+            
+            # Resumo incremental: bancos antigos recebem as colunas e o resumo é refeito na primeira leitura
+            for column, column_type in (('conversation_summary_cached', 'TEXT'), ('summary_updated_ts', 'TIMESTAMP')):
+                if column not in existing:
+                    conn.execute(f"ALTER TABLE user_preferences ADD COLUMN {column} {column_type}")
+            
+            # Índices para o histórico recente (ORDER BY ... LIMIT) e para as estatísticas
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_conv_chat_ts ON conversations(chat_id, timestamp DESC)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_conv_chat_flags "
+                "ON conversations(chat_id, has_errors, is_voice, message_type)"
+            )
     
     def get_or_create_user(self, chat_id: int, username: str = None, 
                           first_name: str = None, last_name: str = None) -> Dict:
         """Obtém ou cria um usuário no banco"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        with self._lock:
+            conn = self._conn
             
             # Tenta encontrar usuário existente
-            user = conn.execute(
-                "SELECT * FROM users WHERE chat_id = ?", (chat_id,)
-            ).fetchone()
+            user = conn.execute(_SQL_GET_USER, (chat_id,)).fetchone()
             
             if user:
                 # Atualiza último acesso
-                conn.execute(
-                    "UPDATE users SET last_active = CURRENT_TIMESTAMP WHERE chat_id = ?",
-                    (chat_id,)
-                )
-                conn.commit()
+                conn.execute(_SQL_TOUCH_USER, (chat_id,))
                 return dict(user)
             else:
-                # Cria novo usuário
-                conn.execute("""
-                    INSERT INTO users (chat_id, username, first_name, last_name)
-                    VALUES (?, ?, ?, ?)
-                """, (chat_id, username, first_name, last_name))
-                
-                # Cria preferências padrão
-                conn.execute("""
-                    INSERT INTO user_preferences (chat_id, topics_of_interest, session_count)
-                    VALUES (?, ?, 1)
-                """, (chat_id, json.dumps([])))
-                
-                conn.commit()
+                # Cria novo usuário (usuário + preferências numa única transação)
+                with conn:  # COMMIT ao final, ROLLBACK se algo falhar
+                    conn.execute("BEGIN")
+                    conn.execute(_SQL_INSERT_USER, (chat_id, username, first_name, last_name))
+                    
+                    # Cria preferências padrão
+                    conn.execute(_SQL_INSERT_PREFERENCES, (chat_id, '[]'))
+                self._ctx_cache.pop(chat_id, None)
                 
                 return {
                     'chat_id': chat_id,
@@ -104,137 +239,154 @@ class HistoryService:
                     is_voice: bool = False, has_errors: bool = False, 
                     grammar_corrections: List[Dict] = None):
         """Salva uma mensagem na conversa"""
-        corrections_json = json.dumps(grammar_corrections) if grammar_corrections else None
+        corrections_json = orjson.dumps(grammar_corrections).decode() if grammar_corrections else None
         
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute("""
-                INSERT INTO conversations 
-                (chat_id, message_type, content, is_voice, has_errors, grammar_corrections)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (chat_id, message_type, content, is_voice, has_errors, corrections_json))
-            conn.commit()
+        with self._lock:
+            conn = self._conn
+            with conn:  # COMMIT ao final, ROLLBACK se algo falhar
+                conn.execute("BEGIN")
+                conn.execute(_SQL_INSERT_CONVERSATION,
+                             (chat_id, message_type, content, is_voice, has_errors, corrections_json))
+                conn.execute(_SQL_INCREMENT_STATS,
+                             (int(message_type == 'user'), int(bool(has_errors)), int(bool(is_voice)), chat_id))
+                
+                # Acrescenta a mensagem ao resumo mantendo só as últimas linhas
+                cached = conn.execute(_SQL_GET_SUMMARY, (chat_id,)).fetchone()
+                if cached is not None:
+                    if cached[0] is None:
+                        lines = [_summary_line(msg['message_type'], msg['content'])
+                                 for msg in self._get_conversation_history(conn, chat_id, _SUMMARY_LINES)]
+                    else:
+                        lines = orjson.loads(cached[0])
+                        lines.append(_summary_line(message_type, content))
+                    conn.execute(_SQL_SET_SUMMARY, (orjson.dumps(lines[-_SUMMARY_LINES:]).decode(), chat_id))
+            self._ctx_cache.pop(chat_id, None)
     
     def get_conversation_history(self, chat_id: int, limit: int = 10) -> List[Dict]:
         """Obtém o histórico recente de conversas"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            
-            rows = conn.execute("""
-                SELECT * FROM conversations 
-                WHERE chat_id = ? 
-                ORDER BY timestamp DESC 
-                LIMIT ?
-            """, (chat_id, limit)).fetchall()
-            
-            history = []
-            for row in rows:
-                history.append({
-                    'message_type': row['message_type'],
-                    'content': row['content'],
-                    'is_voice': bool(row['is_voice']),
-                    'has_errors': bool(row['has_errors']),
-                    'grammar_corrections': json.loads(row['grammar_corrections']) if row['grammar_corrections'] else None,
-                    'timestamp': row['timestamp']
-                })
-            
-            return list(reversed(history))  # Ordem cronológica
+        with self._lock:
+            return self._get_conversation_history(self._conn, chat_id, limit)
+    
+    def _get_conversation_history(self, conn: sqlite3.Connection, chat_id: int, limit: int) -> List[Dict]:
+        """Lê o histórico usando uma conexão já aberta (chamar com o lock adquirido)"""
+        rows = conn.execute(_SQL_RECENT_HISTORY, (chat_id, limit)).fetchall()
+        
+        history = []
+        for row in rows:
+            history.append({
+                'message_type': row['message_type'],
+                'content': row['content'],
+                'is_voice': bool(row['is_voice']),
+                'has_errors': bool(row['has_errors']),
+                'grammar_corrections': orjson.loads(row['grammar_corrections']) if row['grammar_corrections'] else None,
+                'timestamp': row['timestamp']
+            })
+        
+        return list(reversed(history))  # Ordem cronológica
     
     def update_user_level(self, chat_id: int, level: str):
         """Atualiza o nível de inglês do usuário"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute(
-                "UPDATE users SET english_level = ? WHERE chat_id = ?",
-                (level, chat_id)
-            )
-            conn.commit()
+        with self._lock:
+            self._conn.execute(_SQL_UPDATE_LEVEL, (level, chat_id))
+            self._ctx_cache.pop(chat_id, None)
     
     def get_user_context(self, chat_id: int) -> Dict:
         """Obtém contexto completo do usuário para usar nas respostas"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        with self._lock:
+            cached = self._ctx_cache.get(chat_id)
+            if cached and time.monotonic() - cached[0] < _CONTEXT_TTL:
+                self._ctx_cache.move_to_end(chat_id)
+                return copy.deepcopy(cached[1])
             
-            # Dados do usuário
-            user = conn.execute(
-                "SELECT * FROM users WHERE chat_id = ?", (chat_id,)
-            ).fetchone()
+            conn = self._conn
             
-            if not user:
+            # Dados do usuário e preferências numa única consulta
+            row = conn.execute(_SQL_USER_CONTEXT, (chat_id,)).fetchone()
+            
+            if not row:
                 return {}
             
-            # Preferências
-            prefs = conn.execute(
-                "SELECT * FROM user_preferences WHERE chat_id = ?", (chat_id,)
-            ).fetchone()
-            
-            # Estatísticas da conversa
-            stats = conn.execute("""
-                SELECT 
-                    COUNT(*) as total_messages,
-                    SUM(CASE WHEN message_type = 'user' THEN 1 ELSE 0 END) as user_messages,
-                    SUM(CASE WHEN has_errors = 1 THEN 1 ELSE 0 END) as messages_with_errors,
-                    SUM(CASE WHEN is_voice = 1 THEN 1 ELSE 0 END) as voice_messages
-                FROM conversations WHERE chat_id = ?
-            """, (chat_id,)).fetchone()
-            
-            # Histórico recente
-            recent_history = self.get_conversation_history(chat_id, 6)
-            
-            return {
-                'user': dict(user) if user else {},
-                'preferences': dict(prefs) if prefs else {},
-                'stats': dict(stats) if stats else {},
+            user = {column: row[column] for column in _USER_COLUMNS}
+            prefs = None
+            if row['pref_chat_id'] is not None:
+                prefs = {'chat_id': row['pref_chat_id']}
+                prefs.update((column, row[column]) for column in _PREFERENCE_COLUMNS)
+            
+            # Estatísticas da conversa (contadores mantidos por save_message)
+            stats = {column: row[column] or 0 for column in _STATS_COLUMNS}
+            
+            # Histórico recente (mesma conexão)
+            recent_history = self._get_conversation_history(conn, chat_id, 6)
+            
+            context = {
+                'user': user,
+                'preferences': prefs or {},
+                'stats': stats,
                 'recent_history': recent_history,
                 'user_name': user['first_name'] if user and user['first_name'] else 'there'
             }
+            
+            self._ctx_cache[chat_id] = (time.monotonic(), context)
+            self._ctx_cache.move_to_end(chat_id)
+            if len(self._ctx_cache) > _CONTEXT_CACHE_SIZE:
+                self._ctx_cache.popitem(last=False)
+            
+            return copy.deepcopy(context)
     
     def increment_session_count(self, chat_id: int):
         """Incrementa contador de sessões do usuário"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute("""
-                UPDATE user_preferences 
-                SET session_count = session_count + 1 
-                WHERE chat_id = ?
-            """, (chat_id,))
-            conn.commit()
+        with self._lock:
+            self._conn.execute(_SQL_INCREMENT_SESSIONS, (chat_id,))
+            self._ctx_cache.pop(chat_id, None)
     
     def add_topic_interest(self, chat_id: int, topic: str):
         """Adiciona um tópico de interesse do usuário"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        with self._lock:
+            conn = self._conn
             
-            prefs = conn.execute(
-                "SELECT topics_of_interest FROM user_preferences WHERE chat_id = ?",
-                (chat_id,)
-            ).fetchone()
+            prefs = conn.execute(_SQL_GET_TOPICS, (chat_id,)).fetchone()
             
             if prefs:
-                topics = json.loads(prefs['topics_of_interest'] or '[]')
+                topics = orjson.loads(prefs['topics_of_interest'] or '[]')
                 if topic not in topics:
                     topics.append(topic)
-                    conn.execute("""
-                        UPDATE user_preferences 
-                        SET topics_of_interest = ? 
-                        WHERE chat_id = ?
-                    """, (json.dumps(topics), chat_id))
-                    conn.commit()
+                    conn.execute(_SQL_SET_TOPICS, (orjson.dumps(topics).decode(), chat_id))
+                    self._ctx_cache.pop(chat_id, None)
+    
+    def has_history(self, chat_id: int) -> bool:
+        """Verifica se o usuário já tem mensagens, sem materializar linhas"""
+        with self._lock:
+            return self._has_history(self._conn, chat_id)
+    
+    def _has_history(self, conn: sqlite3.Connection, chat_id: int) -> bool:
+        return bool(conn.execute(_SQL_HAS_HISTORY, (chat_id,)).fetchone()[0])
     
     def get_conversation_summary(self, chat_id: int) -> str:
         """Gera um resumo da conversa para contexto"""
-        context = self.get_user_context(chat_id)
-        
-        if not context.get('recent_history'):
-            return "This is our first conversation!"
+        with self._lock:
+            conn = self._conn
+            
+            user = conn.execute(_SQL_SUMMARY_USER, (chat_id,)).fetchone()
+            
+            if not user:
+                return "This is our first conversation!"
+            
+            if user['conversation_summary_cached'] is not None:
+                lines = orjson.loads(user['conversation_summary_cached'])
+            elif not self._has_history(conn, chat_id):
+                return "This is our first conversation!"
+            else:
+                # Banco antigo: monta o resumo a partir das 4 mensagens e guarda para as próximas leituras
+                lines = [_summary_line(msg['message_type'], msg['content'])
+                         for msg in self._get_conversation_history(conn, chat_id, _SUMMARY_LINES)]
+                conn.execute(_SQL_SET_SUMMARY, (orjson.dumps(lines).decode(), chat_id))
         
-        user_name = context['user_name']
-        level = context.get('user', {}).get('english_level', 'B1')
-        total_messages = context.get('stats', {}).get('total_messages', 0)
+        user_name = user['first_name'] or 'there'
+        level = user['english_level']
+        total_messages = user['total_messages'] or 0
         
         summary = f"Previous conversation context with {user_name} (Level: {level}):\n"
-        
-        for msg in context['recent_history'][-4:]:  # Últimas 4 mensagens
-            role = "Student" if msg['message_type'] == 'user' else "Sarah"
-            content = msg['content'][:100] + "..." if len(msg['content']) > 100 else msg['content']
-            summary += f"- {role}: {content}\n"
+        summary += "".join(f"{line}\n" for line in lines)
         
         if total_messages > 10:
             summary += f"\n(This student has been practicing with me for {total_messages} messages)"
@@ -1,7 +1,11 @@
 import time
 import logging
+from collections import deque
 from dataclasses import dataclass, field
-from typing import Dict, List
+from typing import Deque, Dict
+
+# Janela da média móvel do tempo de resposta
+RESPONSE_TIME_WINDOW = 100
 
 @dataclass
 class Metrics:
@@ -10,7 +14,8 @@ class Metrics:
     total_errors: int = 0
     avg_response_time: float = 0
     daily_users: set = field(default_factory=set)
-    response_times: List[float] = field(default_factory=list)
+    response_times: Deque[float] = field(default_factory=lambda: deque(maxlen=RESPONSE_TIME_WINDOW))
+    response_time_sum: float = 0.0
     
 class MetricsService:
     def __init__(self):
@@ -25,13 +30,15 @@ class MetricsService:
             self.metrics.total_voice += 1
         
         self.metrics.daily_users.add(user_id)
-        self.metrics.response_times.append(response_time)
         
-        # Calcular média móvel
-        if len(self.metrics.response_times) > 100:
-            self.metrics.response_times = self.metrics.response_times[-100:]
+        # Calcular média móvel (soma mantida incrementalmente; o deque descarta o mais antigo)
+        times = self.metrics.response_times
+        if len(times) == times.maxlen:
+            self.metrics.response_time_sum -= times[0]
+        times.append(response_time)
+        self.metrics.response_time_sum += response_time
         
-        self.metrics.avg_response_time = sum(self.metrics.response_times) / len(self.metrics.response_times)
+        self.metrics.avg_response_time = self.metrics.response_time_sum / len(times)
     
     async def get_stats(self) -> Dict:
         """Retorna estatísticas"""
@@ -1,45 +1,195 @@
 import sqlite3
-import json
+import asyncio
+import orjson
 import logging
-from datetime import datetime
-from typing import Dict, List, Optional, Tuple
+import threading
+import time
+import re
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Dict, List, Optional
 from pathlib import Path
 import os
 
 logger = logging.getLogger(__name__)
 
+# Aplicados a cada conexão aberta (journal_mode=WAL fica gravado no arquivo, os demais valem por conexão)
+_CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-20000",
+    "PRAGMA busy_timeout=5000",
+)
+
+# Conexões persistentes mantidas abertas (uma por chat); as menos usadas são fechadas
+_MAX_OPEN_CONNECTIONS = 512
+
+# Banco único por chat; os dois arquivos do layout antigo são importados na primeira abertura
+_CHAT_DB = "chat.db"
+_LEGACY_DATABASES = ("profile.db", "conversations.db")
+
+# Colunas lidas por get_conversation_history, na ordem desempacotada ao montar cada mensagem
+_MESSAGE_COLUMNS = (
+    "id, session_id, message_type, content, original_content, is_voice, voice_duration, has_errors, "
+    "grammar_corrections, vocabulary_suggestions, confidence_score, response_time, timestamp, message_context"
+)
+
+# "Últimas N mensagens" com LIMIT literal para os tamanhos usados no caminho quente
+# (contexto = 8, handlers = 10); cada texto fica preparado no cache de statements da conexão
+_SQL_LAST_MESSAGES = f"""
+    SELECT {_MESSAGE_COLUMNS} FROM messages 
+    ORDER BY timestamp DESC, id DESC 
+    LIMIT ?
+"""
+_SQL_LAST_MESSAGES_BY_LIMIT = {
+    limit: _SQL_LAST_MESSAGES.replace("LIMIT ?", f"LIMIT {limit}") for limit in (8, 10, 100)
+}
+
+# Índices do histórico: últimas N mensagens e mensagens de uma sessão. idx_msg_time é
+# ascendente de propósito: percorrido de trás para frente atende "timestamp DESC, id DESC" sem ordenar
+_MESSAGE_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS idx_msg_time ON messages(timestamp)",
+    "CREATE INDEX IF NOT EXISTS idx_msg_session_time ON messages(session_id, timestamp)",
+    "CREATE INDEX IF NOT EXISTS idx_corrections_message ON corrections(message_id)",
+    "CREATE INDEX IF NOT EXISTS idx_vocab_message ON vocab_suggestions(message_id)",
+)
+
+# Lógica simples para identificar tópicos: todos os termos numa única regex
+_COMMON_TOPICS = ('work', 'family', 'travel', 'food', 'movies', 'music',
+                  'sports', 'books', 'weather', 'hobbies', 'school', 'friends')
+_TOPICS_RE = re.compile('|'.join(_COMMON_TOPICS))
+
+# SQL do caminho quente, definido uma vez para reaproveitar o cache de statements de cada conexão
+_SQL_INSERT_PROFILE = """
+    INSERT INTO user_profile (username, first_name, last_name)
+    VALUES (?, ?, ?)
+"""
+_SQL_INSERT_PREFERENCES = """
+    INSERT INTO user_preferences (topics_of_interest)
+    VALUES (?)
+"""
+_SQL_GET_PROFILE = "SELECT * FROM user_profile LIMIT 1"
+
+# Perfil e preferências (tabelas de uma linha) lidos numa única consulta e separados pelas colunas
+_PROFILE_COLUMNS = (
+    "id", "username", "first_name", "last_name", "english_level", "created_at", "last_active",
+    "total_sessions", "total_messages", "voice_messages", "corrected_errors"
+)
+_PREFERENCES_COLUMNS = (
+    "id", "topics_of_interest", "learning_goals", "preferred_response_style", "practice_focus",
+    "difficulty_preference", "lesson_reminders", "progress_tracking"
+)
+_SQL_GET_PROFILE_AND_PREFERENCES = f"""
+    SELECT {", ".join(f"p.{c}" for c in _PROFILE_COLUMNS)}, {", ".join(f"pr.{c}" for c in _PREFERENCES_COLUMNS)}
+    FROM user_profile p LEFT JOIN user_preferences pr ON 1 = 1
+    LIMIT 1
+"""
+_SQL_TOUCH_PROFILE = "UPDATE user_profile SET last_active = CURRENT_TIMESTAMP"
+_SQL_INSERT_MESSAGE = """
+    INSERT INTO messages 
+    (session_id, message_type, content, original_content, is_voice, 
+     voice_duration, has_errors, confidence_score, response_time, message_context)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+_SQL_INSERT_CORRECTION = "INSERT INTO corrections (message_id, type, original, corrected, note) VALUES (?, ?, ?, ?, ?)"
+_SQL_INSERT_VOCAB = "INSERT INTO vocab_suggestions (message_id, word, suggestion) VALUES (?, ?, ?)"
+# Correções (kind 0) e vocabulário (kind 1) de um intervalo de mensagens numa única consulta
+_SQL_GET_MESSAGE_DETAILS = """
+    SELECT message_id, 0, type, original, corrected, note FROM corrections
+    WHERE message_id BETWEEN ? AND ?
+    UNION ALL
+    SELECT message_id, 1, word, suggestion, NULL, NULL FROM vocab_suggestions
+    WHERE message_id BETWEEN ? AND ?
+"""
+_SQL_UPDATE_STATS = """
+    UPDATE user_profile SET 
+        total_messages = total_messages + ?,
+        voice_messages = voice_messages + ?,
+        corrected_errors = corrected_errors + ?
+"""
+
 class OptimizedHistoryService:
     def __init__(self, base_data_path: str = "data/chats"):
         """
-        Inicializa o serviço de histórico otimizado com bancos separados por chat_id
+        Inicializa o serviço de histórico otimizado com um banco separado por chat_id
         
         Estrutura:
         data/chats/
         ├── chat_123456789/
-        │   ├── profile.db      (dados do usuário e preferências)
-        │   ├── conversations.db (histórico de conversas)
-        │   └── metadata.json   (informações rápidas de acesso)
+        │   └── chat.db         (perfil, preferências, progresso e histórico de conversas)
         """
         self.base_path = Path(base_data_path)
         self.base_path.mkdir(parents=True, exist_ok=True)
+        
+        # Bancos já inicializados (em WAL), evita reaplicar journal_mode a cada abertura
+        self._wal_ready = set()
+        
+        # chat_id -> conexão aberta, em ordem de uso (LRU)
+        self._connections: "OrderedDict[int, sqlite3.Connection]" = OrderedDict()
+        self._connections_lock = threading.Lock()
+        
+        # Thread dedicada ao SQLite: chamadas do event loop passam por run() e não o bloqueiam
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-db")
         logger.info(f"OptimizedHistoryService inicializado em: {self.base_path}")
     
     def _get_chat_path(self, chat_id: int) -> Path:
         """Retorna o caminho do diretório específico do chat"""
         return self.base_path / f"chat_{chat_id}"
     
-    def _init_chat_database(self, chat_id: int):
-        """Inicializa os bancos de dados para um chat específico"""
-        chat_path = self._get_chat_path(chat_id)
-        chat_path.mkdir(exist_ok=True)
-        
-        # Banco de perfil do usuário
-        profile_db = chat_path / "profile.db"
-        with sqlite3.connect(profile_db) as conn:
+    def _connect(self, db_path: Path) -> sqlite3.Connection:
+        """Abre uma conexão em autocommit com os PRAGMAs de desempenho aplicados"""
+        conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        pragmas = _CONNECTION_PRAGMAS if db_path not in self._wal_ready else _CONNECTION_PRAGMAS[1:]
+        for pragma in pragmas:
+            conn.execute(pragma)
+        self._wal_ready.add(db_path)
+        return conn
+    
+    def _get_conn(self, chat_id: int) -> sqlite3.Connection:
+        """Retorna a conexão persistente do banco do chat, abrindo se necessário"""
+        with self._connections_lock:
+            conn = self._connections.get(chat_id)
+            if conn is not None:
+                self._connections.move_to_end(chat_id)
+                return conn
+            
+            chat_path = self._get_chat_path(chat_id)
+            conn = self._connect(chat_path / _CHAT_DB)
+            self._init_chat_database(conn)
+            for db_name in _LEGACY_DATABASES:
+                if (chat_path / db_name).exists():
+                    self._import_legacy_database(conn, chat_path / db_name)
+            
+            self._connections[chat_id] = conn
+            if len(self._connections) > _MAX_OPEN_CONNECTIONS:
+                _, evicted = self._connections.popitem(last=False)
+                evicted.close()
+            return conn
+    
+    async def run(self, func, *args, **kwargs):
+        """Executa um método do serviço na thread do banco, sem bloquear o event loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+    
+    def close(self):
+        """Aguarda as chamadas pendentes e fecha todas as conexões abertas"""
+        self._executor.shutdown(wait=True)
+        with self._connections_lock:
+            for conn in self._connections.values():
+                conn.close()
+            self._connections.clear()
+    
+    def _init_chat_database(self, conn: sqlite3.Connection):
+        """Cria as tabelas do chat.db, se ainda não existirem"""
+        # Perfil do usuário (o chat_id está no nome do diretório, não nas tabelas)
+        with conn:
             conn.execute("""
                 CREATE TABLE IF NOT EXISTS user_profile (
                     id INTEGER PRIMARY KEY,
-                    chat_id INTEGER UNIQUE,
                     username TEXT,
                     first_name TEXT,
                     last_name TEXT,
@@ -56,39 +206,35 @@ class OptimizedHistoryService:
             conn.execute("""
                 CREATE TABLE IF NOT EXISTS user_preferences (
                     id INTEGER PRIMARY KEY,
-                    chat_id INTEGER UNIQUE,
                     topics_of_interest TEXT,  -- JSON array
                     learning_goals TEXT,
                     preferred_response_style TEXT DEFAULT 'friendly',
                     practice_focus TEXT,      -- grammar, vocabulary, conversation, etc.
                     difficulty_preference TEXT DEFAULT 'adaptive',
                     lesson_reminders BOOLEAN DEFAULT TRUE,
-                    progress_tracking BOOLEAN DEFAULT TRUE,
-                    FOREIGN KEY (chat_id) REFERENCES user_profile (chat_id)
+                    progress_tracking BOOLEAN DEFAULT TRUE
                 )
             """)
             
             conn.execute("""
                 CREATE TABLE IF NOT EXISTS learning_progress (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    chat_id INTEGER,
                     skill_area TEXT,      -- grammar, vocabulary, speaking, etc.
                     level_assessment TEXT, -- A1, A2, B1, B2, C1, C2
                     progress_score REAL DEFAULT 0.0,
                     last_practiced TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     strengths TEXT,       -- JSON array
-                    weaknesses TEXT,      -- JSON array
-                    FOREIGN KEY (chat_id) REFERENCES user_profile (chat_id)
+                    weaknesses TEXT       -- JSON array
                 )
             """)
-        
-        # Banco de conversas
-        conversations_db = chat_path / "conversations.db"
-        with sqlite3.connect(conversations_db) as conn:
+            
+            # Valores avulsos do chat (ex.: topics_discussed), em JSON
+            conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT)")
+            
+            # Histórico de conversas
             conn.execute("""
                 CREATE TABLE IF NOT EXISTS messages (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    chat_id INTEGER,
                     session_id TEXT,      -- UUID para agrupar mensagens da mesma sessão
                     message_type TEXT,    -- 'user', 'sarah', 'system'
                     content TEXT,
@@ -108,7 +254,6 @@ class OptimizedHistoryService:
             conn.execute("""
                 CREATE TABLE IF NOT EXISTS conversation_sessions (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    chat_id INTEGER,
                     session_id TEXT UNIQUE,
                     session_start TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     session_end TIMESTAMP,
@@ -120,26 +265,58 @@ class OptimizedHistoryService:
                     session_summary TEXT
                 )
             """)
-        
-        # Arquivo de metadata para acesso rápido
-        metadata_file = chat_path / "metadata.json"
-        if not metadata_file.exists():
-            initial_metadata = {
-                "chat_id": chat_id,
-                "created_at": datetime.now().isoformat(),
-                "last_access": datetime.now().isoformat(),
-                "total_sessions": 0,
-                "current_level": "B1",
-                "quick_stats": {
-                    "total_messages": 0,
-                    "voice_messages": 0,
-                    "corrections_made": 0,
-                    "topics_discussed": []
-                }
-            }
-            with open(metadata_file, 'w', encoding='utf-8') as f:
-                json.dump(initial_metadata, f, indent=2, ensure_ascii=False)
+            
+            # Correções e sugestões de vocabulário normalizadas (uma linha por item da mensagem)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS corrections (
+                    message_id INTEGER,   -- messages.id
+                    type TEXT,            -- categoria do erro
+                    original TEXT,
+                    corrected TEXT,       -- primeira sugestão
+                    note TEXT             -- explicação da regra
+                )
+            """)
+            
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS vocab_suggestions (
+                    message_id INTEGER,   -- messages.id
+                    word TEXT,
+                    suggestion TEXT
+                )
+            """)
+            
+            for index_sql in _MESSAGE_INDEXES:
+                conn.execute(index_sql)
     
+    def _import_legacy_database(self, conn: sqlite3.Connection, legacy_path: Path):
+        """Copia as tabelas de um profile.db/conversations.db antigo para o chat.db
+        
+        Só as colunas que existem nas duas versões são copiadas (ex.: chat_id antigo fica de fora).
+        O arquivo importado é renomeado para .migrated e não é mais lido.
+        """
+        conn.execute("ATTACH DATABASE ? AS legacy", (str(legacy_path),))
+        try:
+            conn.execute("BEGIN")
+            tables = conn.execute(
+                "SELECT name FROM legacy.sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+            ).fetchall()
+            for (table,) in tables:
+                current = {row['name'] for row in conn.execute(f"PRAGMA main.table_info({table})")}
+                columns = [row['name'] for row in conn.execute(f"PRAGMA legacy.table_info({table})")
+                           if row['name'] in current]
+                if columns:
+                    column_list = ", ".join(columns)
+                    conn.execute(f"INSERT INTO main.{table} ({column_list}) SELECT {column_list} FROM legacy.{table}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.execute("DETACH DATABASE legacy")
+        
+        legacy_path.rename(legacy_path.with_name(legacy_path.name + ".migrated"))
+        logger.info(f"Banco antigo importado para {_CHAT_DB}: {legacy_path}")
+        
     def get_or_create_user(self, chat_id: int, username: str = None, 
                           first_name: str = None, last_name: str = None) -> Dict:
         """Obtém ou cria um usuário com banco próprio"""
@@ -148,44 +325,23 @@ class OptimizedHistoryService:
         # Se não existe o diretório, cria tudo do zero
         if not chat_path.exists():
             logger.info(f"Criando novo banco para chat_id: {chat_id}")
-            self._init_chat_database(chat_id)
+            chat_path.mkdir()
             
-            # Cria o perfil inicial
-            profile_db = chat_path / "profile.db"
-            with sqlite3.connect(profile_db) as conn:
-                conn.execute("""
-                    INSERT INTO user_profile (chat_id, username, first_name, last_name)
-                    VALUES (?, ?, ?, ?)
-                """, (chat_id, username, first_name, last_name))
-                
-                conn.execute("""
-                    INSERT INTO user_preferences (chat_id, topics_of_interest)
-                    VALUES (?, ?)
-                """, (chat_id, json.dumps([])))
-                
-                conn.commit()
+            # Cria o perfil inicial (as tabelas são criadas ao abrir a conexão)
+            with self._get_conn(chat_id) as conn:
+                conn.execute("BEGIN")
+                conn.execute(_SQL_INSERT_PROFILE, (username, first_name, last_name))
+                conn.execute(_SQL_INSERT_PREFERENCES, ('[]',))
         
         # Carrega o perfil existente
-        profile_db = chat_path / "profile.db"
-        with sqlite3.connect(profile_db) as conn:
-            conn.row_factory = sqlite3.Row
-            
-            user = conn.execute(
-                "SELECT * FROM user_profile WHERE chat_id = ?", (chat_id,)
-            ).fetchone()
+        with self._get_conn(chat_id) as conn:
+            user = conn.execute(_SQL_GET_PROFILE).fetchone()
             
             if user:
                 # Atualiza último acesso
-                conn.execute(
-                    "UPDATE user_profile SET last_active = CURRENT_TIMESTAMP WHERE chat_id = ?",
-                    (chat_id,)
-                )
-                conn.commit()
-                
-                # Atualiza metadata
-                self._update_metadata(chat_id, "last_access", datetime.now().isoformat())
+                conn.execute(_SQL_TOUCH_PROFILE)
                 
-                return dict(user)
+                return dict(user, chat_id=chat_id)
         
         return {}
     
@@ -199,90 +355,135 @@ class OptimizedHistoryService:
                     original_content: str = None,
                     message_context: str = None):
         """Salva uma mensagem no banco específico do chat"""
+        self.save_messages_bulk(chat_id, [{
+            'message_type': message_type, 'content': content, 'session_id': session_id,
+            'is_voice': is_voice, 'voice_duration': voice_duration, 'has_errors': has_errors,
+            'grammar_corrections': grammar_corrections,
+            'vocabulary_suggestions': vocabulary_suggestions,
+            'confidence_score': confidence_score, 'response_time': response_time,
+            'original_content': original_content, 'message_context': message_context,
+        }])
+    
+    def save_messages_bulk(self, chat_id: int, messages: List[Dict]):
+        """Salva várias mensagens do chat numa única transação (um fsync por turno)
         
-        # Gera session_id se não fornecido
-        if not session_id:
-            session_id = f"session_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-        
-        chat_path = self._get_chat_path(chat_id)
-        conversations_db = chat_path / "conversations.db"
-        
-        corrections_json = json.dumps(grammar_corrections, ensure_ascii=False) if grammar_corrections else None
-        vocab_json = json.dumps(vocabulary_suggestions, ensure_ascii=False) if vocabulary_suggestions else None
-        
-        with sqlite3.connect(conversations_db) as conn:
-            conn.execute("""
-                INSERT INTO messages 
-                (chat_id, session_id, message_type, content, original_content, is_voice, 
-                 voice_duration, has_errors, grammar_corrections, vocabulary_suggestions,
-                 confidence_score, response_time, message_context)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (chat_id, session_id, message_type, content, original_content or content,
-                  is_voice, voice_duration, has_errors, corrections_json, vocab_json,
-                  confidence_score, response_time, message_context))
-            conn.commit()
-        
-        # Atualiza estatísticas no perfil
-        self._update_user_stats(chat_id, is_voice, has_errors)
-        
-        # Atualiza metadata rápida
-        metadata = self._get_metadata(chat_id)
-        if metadata:
-            metadata["quick_stats"]["total_messages"] += 1
-            if is_voice:
-                metadata["quick_stats"]["voice_messages"] += 1
-            if has_errors:
-                metadata["quick_stats"]["corrections_made"] += 1
-            self._save_metadata(chat_id, metadata)
+        Cada item aceita os mesmos campos nomeados de save_message.
+        """
+        if not messages:
+            return
+        
+        # Gera session_id curto e único se não fornecido (o antigo, por segundo, colidia)
+        default_session = f"s{time.time_ns()}"
+        
+        rows = []
+        voice_count = 0
+        error_count = 0
+        for msg in messages:
+            content = msg['content']
+            is_voice = msg.get('is_voice', False)
+            has_errors = msg.get('has_errors', False)
+            rows.append(((
+                msg.get('session_id') or default_session, msg['message_type'],
+                content, msg.get('original_content') or content, is_voice,
+                msg.get('voice_duration', 0.0), has_errors,
+                msg.get('confidence_score', 1.0), msg.get('response_time', 0.0),
+                msg.get('message_context'),
+            ), msg.get('grammar_corrections'), msg.get('vocabulary_suggestions')))
+            voice_count += 1 if is_voice else 0
+            error_count += 1 if has_errors else 0
+        
+        # Mensagens, correções, vocabulário e estatísticas do perfil num único BEGIN/COMMIT
+        with self._get_conn(chat_id) as conn:
+            conn.execute("BEGIN")
+            correction_rows = []
+            vocab_rows = []
+            for row, corrections, vocabulary in rows:
+                message_id = conn.execute(_SQL_INSERT_MESSAGE, row).lastrowid
+                for item in corrections or ():
+                    suggestions = item.get('suggestions')
+                    correction_rows.append((
+                        message_id, item.get('category'), item.get('original'),
+                        suggestions[0] if suggestions else item.get('correct'), item.get('rule')
+                    ))
+                for item in vocabulary or ():
+                    vocab_rows.append((message_id, item.get('word'), item.get('suggestion')))
+            if correction_rows:
+                conn.executemany(_SQL_INSERT_CORRECTION, correction_rows)
+            if vocab_rows:
+                conn.executemany(_SQL_INSERT_VOCAB, vocab_rows)
+            conn.execute(_SQL_UPDATE_STATS, (len(rows), voice_count, error_count))
     
     def get_conversation_history(self, chat_id: int, limit: int = 10, 
                                session_id: str = None) -> List[Dict]:
         """Obtém histórico de conversas do banco específico"""
-        chat_path = self._get_chat_path(chat_id)
-        conversations_db = chat_path / "conversations.db"
-        
-        if not conversations_db.exists():
+        if not self._get_chat_path(chat_id).exists():
             return []
         
-        with sqlite3.connect(conversations_db) as conn:
-            conn.row_factory = sqlite3.Row
-            
+        with self._get_conn(chat_id) as conn:
             if session_id:
-                query = """
-                    SELECT * FROM messages 
-                    WHERE chat_id = ? AND session_id = ?
-                    ORDER BY timestamp ASC
+                query = f"""
+                    SELECT {_MESSAGE_COLUMNS} FROM messages 
+                    WHERE session_id = ?
+                    ORDER BY timestamp ASC, id ASC
                 """
-                params = (chat_id, session_id)
+                params = (session_id,)
+            elif limit in _SQL_LAST_MESSAGES_BY_LIMIT:
+                query = _SQL_LAST_MESSAGES_BY_LIMIT[limit]
+                params = ()
             else:
-                query = """
-                    SELECT * FROM messages 
-                    WHERE chat_id = ? 
-                    ORDER BY timestamp DESC 
-                    LIMIT ?
-                """
-                params = (chat_id, limit)
+                query = _SQL_LAST_MESSAGES
+                params = (limit,)
             
-            rows = conn.execute(query, params).fetchall()
+            # Tuplas simples (sem sqlite3.Row), percorridas direto do cursor
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            cursor.execute(query, params)
             
-            history = []
-            for row in rows:
-                history.append({
-                    'id': row['id'],
-                    'session_id': row['session_id'],
-                    'message_type': row['message_type'],
-                    'content': row['content'],
-                    'original_content': row['original_content'],
-                    'is_voice': bool(row['is_voice']),
-                    'voice_duration': row['voice_duration'],
-                    'has_errors': bool(row['has_errors']),
-                    'grammar_corrections': json.loads(row['grammar_corrections']) if row['grammar_corrections'] else None,
-                    'vocabulary_suggestions': json.loads(row['vocabulary_suggestions']) if row['vocabulary_suggestions'] else None,
-                    'confidence_score': row['confidence_score'],
-                    'response_time': row['response_time'],
-                    'timestamp': row['timestamp'],
-                    'message_context': row['message_context']
-                })
+            history = [
+                {
+                    'id': message_id,
+                    'session_id': message_session,
+                    'message_type': message_type,
+                    'content': content,
+                    'original_content': original_content,
+                    'is_voice': bool(is_voice),
+                    'voice_duration': voice_duration,
+                    'has_errors': bool(has_errors),
+                    # Colunas JSON só existem em mensagens gravadas antes das tabelas normalizadas
+                    'grammar_corrections': orjson.loads(corrections) if corrections else None,
+                    'vocabulary_suggestions': orjson.loads(vocabulary) if vocabulary else None,
+                    'confidence_score': confidence_score,
+                    'response_time': response_time,
+                    'timestamp': timestamp,
+                    'message_context': message_context
+                }
+                for (message_id, message_session, message_type, content, original_content, is_voice,
+                     voice_duration, has_errors, corrections, vocabulary, confidence_score,
+                     response_time, timestamp, message_context) in cursor
+            ]
+            
+            # Correções e vocabulário das mensagens lidas, numa consulta pelo intervalo de ids
+            if history:
+                by_id = {msg['id']: msg for msg in history}
+                low, high = min(by_id), max(by_id)
+                cursor.execute(_SQL_GET_MESSAGE_DETAILS, (low, high, low, high))
+                for message_id, kind, first, second, corrected, note in cursor:
+                    msg = by_id.get(message_id)
+                    if msg is None:
+                        continue
+                    if kind == 0:
+                        item = {key: value for key, value in
+                                (('rule', note), ('category', first), ('original', second)) if value is not None}
+                        if corrected is not None:
+                            item['suggestions'] = [corrected]
+                        key = 'grammar_corrections'
+                    else:
+                        item = {key: value for key, value in
+                                (('word', first), ('suggestion', second)) if value is not None}
+                        key = 'vocabulary_suggestions'
+                    if msg[key] is None:
+                        msg[key] = []
+                    msg[key].append(item)
             
             if not session_id:
                 history.reverse()  # Ordem cronológica para histórico geral
@@ -296,25 +497,19 @@ class OptimizedHistoryService:
         if not chat_path.exists():
             return {}
         
-        # Carrega metadata rápida primeiro
-        metadata = self._get_metadata(chat_id)
-        
-        # Carrega perfil completo
-        profile_db = chat_path / "profile.db"
-        with sqlite3.connect(profile_db) as conn:
-            conn.row_factory = sqlite3.Row
+        # Perfil + preferências numa consulta, progresso e histórico na mesma conexão
+        with self._get_conn(chat_id) as conn:
+            row = conn.execute(_SQL_GET_PROFILE_AND_PREFERENCES).fetchone()
             
-            user = conn.execute(
-                "SELECT * FROM user_profile WHERE chat_id = ?", (chat_id,)
-            ).fetchone()
+            user = dict(zip(_PROFILE_COLUMNS, row), chat_id=chat_id) if row else {}
+            prefs = {}
+            if row and row[len(_PROFILE_COLUMNS)] is not None:
+                prefs = dict(zip(_PREFERENCES_COLUMNS, row[len(_PROFILE_COLUMNS):]), chat_id=chat_id)
             
-            prefs = conn.execute(
-                "SELECT * FROM user_preferences WHERE chat_id = ?", (chat_id,)
-            ).fetchone()
+            metadata = self._build_metadata(conn, chat_id, user) if user else {}
             
             progress = conn.execute(
-                "SELECT * FROM learning_progress WHERE chat_id = ? ORDER BY last_practiced DESC",
-                (chat_id,)
+                "SELECT * FROM learning_progress ORDER BY last_practiced DESC LIMIT 20"
             ).fetchall()
         
         # Histórico recente
@@ -324,90 +519,77 @@ class OptimizedHistoryService:
         recent_topics = self._extract_recent_topics(recent_history)
         
         return {
-            'user': dict(user) if user else {},
-            'preferences': dict(prefs) if prefs else {},
+            'user': user,
+            'preferences': prefs,
             'learning_progress': [dict(p) for p in progress] if progress else [],
-            'metadata': metadata or {},
+            'metadata': metadata,
             'recent_history': recent_history,
             'recent_topics': recent_topics,
             'user_name': user['first_name'] if user and user['first_name'] else 'there',
-            'conversation_summary': self._generate_smart_summary(chat_id, recent_history)
+            'conversation_summary': self._generate_smart_summary(recent_history, user)
         }
     
     def update_user_level(self, chat_id: int, level: str):
         """Atualiza nível do usuário no banco específico"""
-        chat_path = self._get_chat_path(chat_id)
-        profile_db = chat_path / "profile.db"
-        
-        with sqlite3.connect(profile_db) as conn:
-            conn.execute(
-                "UPDATE user_profile SET english_level = ? WHERE chat_id = ?",
-                (level, chat_id)
-            )
-            conn.commit()
-        
-        # Atualiza metadata
-        self._update_metadata(chat_id, "current_level", level)
-    
-    def _update_user_stats(self, chat_id: int, is_voice: bool, has_errors: bool):
-        """Atualiza estatísticas do usuário"""
-        chat_path = self._get_chat_path(chat_id)
-        profile_db = chat_path / "profile.db"
-        
-        with sqlite3.connect(profile_db) as conn:
-            conn.execute("""
-                UPDATE user_profile SET 
-                    total_messages = total_messages + 1,
-                    voice_messages = voice_messages + ?,
-                    corrected_errors = corrected_errors + ?
-                WHERE chat_id = ?
-            """, (1 if is_voice else 0, 1 if has_errors else 0, chat_id))
-            conn.commit()
+        with self._get_conn(chat_id) as conn:
+            conn.execute("UPDATE user_profile SET english_level = ?", (level,))
     
     def _get_metadata(self, chat_id: int) -> Dict:
-        """Carrega metadata rápida"""
-        metadata_file = self._get_chat_path(chat_id) / "metadata.json"
-        if metadata_file.exists():
-            with open(metadata_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        return {}
+        """Carrega metadata rápida (contadores do user_profile + tabela kv)"""
+        if not self._get_chat_path(chat_id).exists():
+            return {}
+        with self._get_conn(chat_id) as conn:
+            profile = conn.execute(_SQL_GET_PROFILE).fetchone()
+            return self._build_metadata(conn, chat_id, profile) if profile else {}
     
-    def _save_metadata(self, chat_id: int, metadata: Dict):
-        """Salva metadata"""
-        metadata_file = self._get_chat_path(chat_id) / "metadata.json"
-        with open(metadata_file, 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, indent=2, ensure_ascii=False)
+    def _build_metadata(self, conn: sqlite3.Connection, chat_id: int, profile) -> Dict:
+        """Monta a metadata no formato do antigo metadata.json a partir do perfil já lido"""
+        extra = {key: orjson.loads(value) for key, value in conn.execute("SELECT key, value FROM kv")}
+        metadata = {
+            "chat_id": chat_id,
+            "created_at": profile['created_at'],
+            "last_access": profile['last_active'],
+            "total_sessions": profile['total_sessions'],
+            "current_level": profile['english_level'],
+            "quick_stats": {
+                "total_messages": profile['total_messages'],
+                "voice_messages": profile['voice_messages'],
+                "corrections_made": profile['corrected_errors'],
+                "topics_discussed": extra.pop('topics_discussed', [])
+            }
+        }
+        metadata.update(extra)
+        return metadata
     
     def _update_metadata(self, chat_id: int, key: str, value):
-        """Atualiza um campo específico da metadata"""
-        metadata = self._get_metadata(chat_id)
-        metadata[key] = value
-        self._save_metadata(chat_id, metadata)
+        """Atualiza um campo específico da metadata (tabela kv)"""
+        with self._get_conn(chat_id) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)",
+                (key, orjson.dumps(value).decode())
+            )
     
     def _extract_recent_topics(self, history: List[Dict]) -> List[str]:
         """Extrai tópicos mencionados recentemente"""
         topics = []
         for msg in history[-5:]:  # Últimas 5 mensagens
-            content = msg['content'].lower()
-            # Lógica simples para identificar tópicos
-            common_topics = ['work', 'family', 'travel', 'food', 'movies', 'music', 
-                           'sports', 'books', 'weather', 'hobbies', 'school', 'friends']
-            for topic in common_topics:
-                if topic in content and topic not in topics:
+            # Uma única varredura do texto encontra todos os tópicos da mensagem
+            found = set(_TOPICS_RE.findall(msg['content'].lower()))
+            if not found:
+                continue
+            for topic in _COMMON_TOPICS:
+                if topic in found and topic not in topics:
                     topics.append(topic)
         return topics
     
-    def _generate_smart_summary(self, chat_id: int, recent_history: List[Dict]) -> str:
-        """Gera resumo inteligente da conversa"""
+    def _generate_smart_summary(self, recent_history: List[Dict], user: Dict) -> str:
+        """Gera resumo inteligente da conversa a partir do perfil já carregado"""
         if not recent_history:
             return "This is our first conversation!"
         
-        metadata = self._get_metadata(chat_id)
-        user_context = self.get_or_create_user(chat_id)
-        
-        user_name = user_context.get('first_name', 'Student')
-        level = user_context.get('english_level', 'B1')
-        total_messages = metadata.get('quick_stats', {}).get('total_messages', 0)
+        user_name = user.get('first_name', 'Student')
+        level = user.get('english_level', 'B1')
+        total_messages = user.get('total_messages', 0)
         
         # Últimas interações relevantes
         recent_user_msgs = [msg for msg in recent_history[-6:] if msg['message_type'] == 'user']
@@ -439,15 +621,10 @@ class OptimizedHistoryService:
         if not chat_path.exists():
             return {}
         
-        conversations_db = chat_path / "conversations.db"
-        profile_db = chat_path / "profile.db"
-        
         stats = {}
         
         # Estatísticas de mensagens
-        with sqlite3.connect(conversations_db) as conn:
-            conn.row_factory = sqlite3.Row
-            
+        with self._get_conn(chat_id) as conn:
             msg_stats = conn.execute("""
                 SELECT 
                     COUNT(*) as total,
@@ -456,44 +633,43 @@ class OptimizedHistoryService:
                     SUM(CASE WHEN has_errors = 1 THEN 1 ELSE 0 END) as messages_with_errors,
                     AVG(confidence_score) as avg_confidence,
                     AVG(response_time) as avg_response_time
-                FROM messages WHERE chat_id = ?
-            """, (chat_id,)).fetchone()
+                FROM messages
+            """).fetchone()
             
             stats['messages'] = dict(msg_stats) if msg_stats else {}
         
         # Estatísticas do perfil
-        with sqlite3.connect(profile_db) as conn:
-            conn.row_factory = sqlite3.Row
-            
-            profile_stats = conn.execute(
-                "SELECT * FROM user_profile WHERE chat_id = ?", (chat_id,)
-            ).fetchone()
+        with self._get_conn(chat_id) as conn:
+            profile_stats = conn.execute(_SQL_GET_PROFILE).fetchone()
             
-            stats['profile'] = dict(profile_stats) if profile_stats else {}
+            stats['profile'] = dict(profile_stats, chat_id=chat_id) if profile_stats else {}
         
         stats['metadata'] = metadata
         return stats
     
     def cleanup_old_data(self, chat_id: int, days_old: int = 30):
         """Remove dados antigos para otimizar espaço"""
-        chat_path = self._get_chat_path(chat_id)
-        conversations_db = chat_path / "conversations.db"
-        
-        if conversations_db.exists():
-            with sqlite3.connect(conversations_db) as conn:
-                # Remove mensagens antigas, mantendo pelo menos as últimas 100
+        if self._get_chat_path(chat_id).exists():
+            conn = self._get_conn(chat_id)
+            with conn:
+                # Remove mensagens antigas, mantendo pelo menos as últimas 100:
+                # o corte é o timestamp da 100ª mais recente, calculado uma única vez
+                conn.execute("BEGIN IMMEDIATE")
                 conn.execute("""
                     DELETE FROM messages 
-                    WHERE chat_id = ? 
-                    AND timestamp < datetime('now', '-{} days')
-                    AND id NOT IN (
-                        SELECT id FROM messages 
-                        WHERE chat_id = ? 
+                    WHERE timestamp < datetime('now', ?)
+                    AND timestamp < (
+                        SELECT timestamp FROM messages 
                         ORDER BY timestamp DESC 
-                        LIMIT 100
+                        LIMIT 1 OFFSET 99
                     )
-                """.format(days_old), (chat_id, chat_id))
-                conn.commit()
+                """, (f"-{int(days_old)} days",))
+                # Detalhes das mensagens removidas (sempre as mais antigas, de ids menores)
+                conn.execute("DELETE FROM corrections WHERE message_id < (SELECT MIN(id) FROM messages)")
+                conn.execute("DELETE FROM vocab_suggestions WHERE message_id < (SELECT MIN(id) FROM messages)")
+            
+            # Devolve o WAL ao tamanho mínimo depois da remoção
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
     
     def export_user_data(self, chat_id: int) -> Dict:
         """Exporta todos os dados do usuário"""
@@ -1,15 +1,27 @@
 import asyncio
 from asyncio import Queue
-from typing import Dict, Any
+from typing import Dict, Any, List
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Mensagens acumuladas por chat antes de gravar, e espera máxima (segundos) do buffer
+PERSIST_BATCH_SIZE = 16
+PERSIST_FLUSH_DELAY = 0.5
+
+# Máximo de tarefas retiradas da fila a cada vez que um worker acorda
+WORKER_BATCH_SIZE = 16
+
 class QueueService:
-    def __init__(self, max_workers: int = 3):
+    def __init__(self, max_workers: int = 3, history_service=None):
         self.queue = Queue()
         self.workers = []
         self.max_workers = max_workers
+        
+        # Persistência de mensagens em lote, fora do event loop
+        self.history_service = history_service
+        self._persist_buffers: Dict[int, List[Dict]] = {}
+        self._persist_timers: Dict[int, asyncio.Task] = {}
     
     async def start_workers(self):
         """Inicia workers para processar fila"""
@@ -18,18 +30,37 @@ class QueueService:
             self.workers.append(worker)
     
     async def add_task(self, task: Dict[str, Any]):
-        """Adiciona tarefa na fila"""
+        """Adiciona tarefa na fila (inicia os workers na primeira chamada)"""
+        if not self.workers:
+            await self.start_workers()
         await self.queue.put(task)
     
+    async def stop(self):
+        """Processa o que resta na fila, grava os buffers pendentes e encerra os workers"""
+        if self.workers:
+            await self.queue.join()
+        for chat_id in list(self._persist_buffers):
+            await self._flush_persist(chat_id)
+        for worker in self.workers:
+            worker.cancel()
+        self.workers.clear()
+    
     async def _worker(self, name: str):
-        """Worker que processa tarefas"""
+        """Worker que processa tarefas, em lotes do que já estiver pendente na fila"""
         while True:
-            task = await self.queue.get()
-            try:
-                await self._process_task(task)
-            except Exception as e:
-                logger.error(f"{name} erro: {e}")
-            finally:
+            batch = [await self.queue.get()]
+            while len(batch) < WORKER_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            
+            results = await asyncio.gather(
+                *(self._process_task(task) for task in batch), return_exceptions=True
+            )
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.error(f"{name} erro: {result}")
                 self.queue.task_done()
     
     async def _process_task(self, task: Dict[str, Any]):
@@ -40,6 +71,8 @@ class QueueService:
             await self._process_transcription(task)
         elif task_type == 'tts':
             await self._process_tts(task)
+        elif task_type == 'persist_message':
+            await self._process_persist(task)
     
     async def _process_transcription(self, task):
         # Implementar lógica de transcrição
@@ -48,3 +81,33 @@ class QueueService:
     async def _process_tts(self, task):
         # Implementar lógica de TTS
         pass
+    
+    async def _process_persist(self, task):
+        """Acumula mensagens do chat e grava quando o buffer enche ou o prazo vence"""
+        chat_id = task['chat_id']
+        buffer = self._persist_buffers.setdefault(chat_id, [])
+        buffer.extend(task['messages'])
+        
+        if len(buffer) >= PERSIST_BATCH_SIZE:
+            await self._flush_persist(chat_id)
+        elif chat_id not in self._persist_timers:
+            self._persist_timers[chat_id] = asyncio.create_task(self._flush_persist_later(chat_id))
+    
+    async def _flush_persist_later(self, chat_id: int):
+        await asyncio.sleep(PERSIST_FLUSH_DELAY)
+        self._persist_timers.pop(chat_id, None)
+        await self._flush_persist(chat_id)
+    
+    async def _flush_persist(self, chat_id: int):
+        """Grava o buffer do chat numa única transação, na thread do banco"""
+        timer = self._persist_timers.pop(chat_id, None)
+        if timer:
+            timer.cancel()
+        messages = self._persist_buffers.pop(chat_id, None)
+        if not messages:
+            return
+        
+        try:
+            await self.history_service.run(self.history_service.save_messages_bulk, chat_id, messages)
+        except Exception as e:
+            logger.error(f"Erro ao gravar {len(messages)} mensagens do chat {chat_id}: {e}")
@@ -1,24 +1,49 @@
 import edge_tts
 import asyncio
-import uuid
+import re
 import os
+from hashlib import blake2b
+from io import BytesIO
 import logging
 from typing import Optional, List
 
 logger = logging.getLogger(__name__)
 
+# Limpeza de markdown antes do TTS, compilada uma vez e aplicada em ordem
+_CLEANUP_STEPS = (
+    # Remove bold markdown
+    (re.compile(r'\*\*(.*?)\*\*'), r'\1'),
+    (re.compile(r'__(.*?)__'), r'\1'),
+    # Remove italic markdown
+    (re.compile(r'\*(.*?)\*'), r'\1'),
+    (re.compile(r'_(.*?)_'), r'\1'),
+    # Remove code blocks
+    (re.compile(r'```.*?```', re.DOTALL), ''),
+    (re.compile(r'`(.*?)`'), r'\1'),
+    # Remove headers
+    (re.compile(r'#+\s'), ''),
+    # Remove links mas mantém o texto
+    (re.compile(r'\[([^\]]+)\]\([^\)]+\)'), r'\1'),
+    # Remove emojis (opcional)
+    (re.compile(r'[^\x00-\x7F]+'), ''),
+)
+
+# Máximo de áudios mantidos no cache em disco (os menos usados, por mtime, saem primeiro)
+_TTS_CACHE_MAX_FILES = 500
+
 class TTSService:
     def __init__(self):
         self.voice = os.getenv("TTS_VOICE", "en-US-JennyNeural")
         self.rate = os.getenv("TTS_RATE", "+0%")
         self.pitch = os.getenv("TTS_PITCH", "+0Hz")
-        self.temp_dir = os.path.join(os.getcwd(), "temp")
         
-        # Criar diretório temp se não existir
-        os.makedirs(self.temp_dir, exist_ok=True)
+        # Cache de áudios já gerados, endereçado pelo conteúdo (voz, rate, pitch, texto)
+        self.cache_dir = os.path.join(os.getcwd(), "temp", "cache")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._cache_count = len(os.listdir(self.cache_dir))
     
-    async def generate_speech(self, text: str) -> Optional[str]:
-        """Gera áudio a partir do texto usando Edge-TTS"""
+    async def generate_speech(self, text: str) -> Optional[bytes]:
+        """Gera áudio (mp3) a partir do texto usando Edge-TTS, direto em memória"""
         try:
             # Limpar texto de markdown
             clean_text = self._clean_text(text)
@@ -26,11 +51,14 @@ class TTSService:
             if not clean_text.strip():
                 return None
             
-            # Gerar nome único para o arquivo
-            output_file = os.path.join(
-                self.temp_dir,
-                f"speech_{uuid.uuid4().hex}.mp3"
-            )
+            # Frases recorrentes saem do cache sem ida ao edge-tts
+            cache_key = blake2b(
+                f"{self.voice}|{self.rate}|{self.pitch}|{clean_text}".encode(), digest_size=16
+            ).hexdigest()
+            cache_path = os.path.join(self.cache_dir, f"{cache_key}.mp3")
+            audio = self._read_cache(cache_path)
+            if audio:
+                return audio
             
             # Configurar voz
             communicate = edge_tts.Communicate(
@@ -40,12 +68,17 @@ class TTSService:
                 pitch=self.pitch
             )
             
-            # Gerar e salvar áudio
-            await communicate.save(output_file)
+            # Acumula os chunks de áudio do stream, sem passar pelo disco
+            buffer = BytesIO()
+            async for chunk in communicate.stream():
+                if chunk["type"] == "audio":
+                    buffer.write(chunk["data"])
             
-            if os.path.exists(output_file) and os.path.getsize(output_file) > 0:
-                logger.info(f"Áudio gerado: {output_file}")
-                return output_file
+            audio = buffer.getvalue()
+            if audio:
+                logger.info(f"Áudio gerado: {len(audio)} bytes")
+                self._write_cache(cache_path, audio)
+                return audio
             else:
                 logger.error("Falha ao gerar áudio")
                 return None
@@ -54,30 +87,37 @@ class TTSService:
             logger.error(f"Erro TTS: {e}")
             return None
     
+    def _read_cache(self, cache_path: str) -> Optional[bytes]:
+        """Lê um áudio do cache, renovando o mtime usado na expulsão (LRU)"""
+        try:
+            with open(cache_path, 'rb') as f:
+                audio = f.read()
+            os.utime(cache_path)
+            return audio
+        except OSError:
+            return None
+    
+    def _write_cache(self, cache_path: str, audio: bytes):
+        """Grava o áudio no cache e remove os mais antigos se passar do limite"""
+        try:
+            with open(cache_path, 'wb') as f:
+                f.write(audio)
+            self._cache_count += 1
+            
+            if self._cache_count > _TTS_CACHE_MAX_FILES:
+                entries = sorted(os.scandir(self.cache_dir), key=lambda e: e.stat().st_mtime)
+                # Libera 10% de folga para não varrer o diretório a cada gravação
+                keep = _TTS_CACHE_MAX_FILES * 9 // 10
+                for entry in entries[:len(entries) - keep]:
+                    os.remove(entry.path)
+                self._cache_count = min(len(entries), keep)
+        except OSError as e:
+            logger.warning(f"Erro ao gravar cache TTS: {e}")
+    
     def _clean_text(self, text: str) -> str:
         """Remove markdown e formatação do texto"""
-        import re
-        
-        # Remove bold markdown
-        text = re.sub(r'\*\*(.*?)\*\*', r'\1', text)
-        text = re.sub(r'__(.*?)__', r'\1', text)
-        
-        # Remove italic markdown
-        text = re.sub(r'\*(.*?)\*', r'\1', text)
-        text = re.sub(r'_(.*?)_', r'\1', text)
-        
-        # Remove code blocks
-        text = re.sub(r'```.*?```', '', text, flags=re.DOTALL)
-        text = re.sub(r'`(.*?)`', r'\1', text)
-        
-        # Remove headers
-        text = re.sub(r'#+\s', '', text)
-        
-        # Remove links mas mantém o texto
-        text = re.sub(r'\[([^\]]+)\]\([^\)]+\)', r'\1', text)
-        
-        # Remove emojis (opcional)
-        text = re.sub(r'[^\x00-\x7F]+', '', text)
+        for pattern, replacement in _CLEANUP_STEPS:
+            text = pattern.sub(replacement, text)
         
         return text.strip()
     
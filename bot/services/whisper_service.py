@@ -2,79 +2,184 @@ import aiohttp
 import logging
 import asyncio
 import os
-from typing import Optional
-import whisper
+import time
+import hashlib
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from typing import Optional, Tuple
+from faster_whisper import WhisperModel
 
 logger = logging.getLogger(__name__)
 
+# Transcrições recentes por hash do conteúdo (o mesmo áudio reenviado ou encaminhado)
+_TRANSCRIPTION_CACHE_SIZE = 256
+_TRANSCRIPTION_TTL = 3600
+
+def _hash_file(path: str) -> str:
+    """SHA-256 do arquivo lido em blocos (memória constante mesmo para áudios longos)"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(8 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+@lru_cache(maxsize=4)
+def _get_model(model_size: str, compute_type: str, cpu_threads: int) -> WhisperModel:
+    """Modelo local do processo (pesos carregados uma única vez)"""
+    # CTranslate2 com pesos int8: bem mais rápido e leve que o modelo PyTorch em FP32
+    return WhisperModel(
+        model_size,
+        device="auto",
+        compute_type=compute_type,
+        cpu_threads=cpu_threads,
+        num_workers=1
+    )
+
+# Modelo do processo worker, carregado por _worker_init quando o processo sobe
+_worker_model: Optional[WhisperModel] = None
+
+def _worker_init(model_size: str, compute_type: str, cpu_threads: int):
+    """Inicializador dos processos de transcrição"""
+    global _worker_model
+    _worker_model = _get_model(model_size, compute_type, cpu_threads)
+
+def _worker_transcribe(audio_path: str) -> str:
+    """Transcrição síncrona no processo worker; VAD pula silêncio e beam_size=1 reduz o decoder"""
+    segments, _ = _worker_model.transcribe(
+        audio_path, language='en', vad_filter=True, beam_size=1
+    )
+    # segments é um gerador: a decodificação acontece enquanto é consumido
+    return "".join(segment.text for segment in segments).strip()
+
 class WhisperService:
     def __init__(self):
         self.base_url = "http://whisper-service:5001"
         self.timeout = aiohttp.ClientTimeout(total=30)
-        self.local_model = None
-        self._load_local_model()
+        # Sessão HTTP compartilhada, criada sob demanda dentro do event loop
+        self._session: Optional[aiohttp.ClientSession] = None
+        # hash do áudio -> (expira em, texto), em ordem de uso (LRU)
+        self._cache: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        # Modelo local em processos próprios, criados só no primeiro fallback
+        # (deploys só de texto nunca pagam os pesos)
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._local_enabled = os.getenv("WHISPER_ENABLE_LOCAL", "true").lower() == "true"
     
     def _load_local_model(self):
-        """Carrega modelo Whisper local como fallback"""
-        try:
-            model_size = os.getenv("WHISPER_MODEL", "base")
-            self.local_model = whisper.load_model(model_size)
-            logger.info(f"Modelo Whisper local {model_size} carregado")
-        except Exception as e:
-            logger.warning(f"Erro ao carregar modelo local: {e}")
+        """Cria o pool de processos do Whisper local (cada worker carrega o modelo ao subir)"""
+        model_size = os.getenv("WHISPER_MODEL", "base")
+        workers = max(1, int(os.getenv("WHISPER_WORKERS", "2")))
+        # Threads do CTranslate2 divididas entre os workers, sem disputar os mesmos núcleos
+        cpu_threads = max(1, (os.cpu_count() or 4) // workers)
+        self._pool = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_worker_init,
+            initargs=(model_size, os.getenv("WHISPER_COMPUTE", "int8"), cpu_threads)
+        )
+        logger.info(f"Whisper local {model_size} com {workers} processos")
+    
+    async def _ensure_model(self):
+        """Cria o pool local uma única vez (sem await no meio, nada a travar entre tarefas)"""
+        if self._pool is None and self._local_enabled:
+            self._load_local_model()
+    
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Retorna a sessão HTTP compartilhada, mantendo a conexão viva entre transcrições"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=self.timeout,
+                connector=aiohttp.TCPConnector(limit=32, keepalive_timeout=60)
+            )
+        return self._session
+    
+    async def close(self):
+        """Fecha a sessão HTTP (chamar no encerramento do bot)"""
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        if self._pool:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
     
     async def transcribe(self, audio_path: str) -> Optional[str]:
-        """Transcreve áudio usando Whisper"""
+        """Transcreve áudio usando Whisper (áudios repetidos saem do cache)"""
+        try:
+            key = await asyncio.to_thread(_hash_file, audio_path)
+        except OSError as e:
+            logger.warning(f"Erro ao calcular hash do áudio: {e}")
+            key = None
+        
+        cached = self._cache.get(key)
+        if cached and cached[0] > time.monotonic():
+            self._cache.move_to_end(key)
+            return cached[1]
+        
+        result = None
         try:
             # Tentar serviço remoto primeiro
             result = await self._transcribe_remote(audio_path)
-            if result:
-                return result
         except Exception as e:
             logger.warning(f"Serviço remoto falhou: {e}")
         
-        # Fallback para modelo local
-        return await self._transcribe_local(audio_path)
+        if not result:
+            # Fallback para modelo local
+            result = await self._transcribe_local(audio_path)
+        
+        if result and key:
+            self._cache[key] = (time.monotonic() + _TRANSCRIPTION_TTL, result)
+            self._cache.move_to_end(key)
+            if len(self._cache) > _TRANSCRIPTION_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return result
     
     async def _transcribe_remote(self, audio_path: str) -> Optional[str]:
         """Transcreve usando serviço remoto"""
         try:
-            async with aiohttp.ClientSession(timeout=self.timeout) as session:
-                with open(audio_path, 'rb') as f:
-                    data = aiohttp.FormData()
-                    data.add_field('audio', f, 
-                                 filename='audio.ogg',
-                                 content_type='audio/ogg')
-                    
-                    async with session.post(
-                        f"{self.base_url}/transcribe",
-                        data=data
-                    ) as response:
-                        if response.status == 200:
-                            result = await response.json()
-                            return result.get('text', '').strip()
-                        else:
-                            logger.error(f"Whisper error: {response.status}")
-                            return None
-                            
+            session = await self._get_session()
+            # O aiohttp envia o arquivo em blocos, lidos fora do event loop
+            with open(audio_path, 'rb') as f:
+                data = aiohttp.FormData()
+                data.add_field('audio', f, 
+                             filename='audio.ogg',
+                             content_type='audio/ogg')
+                
+                async with session.post(
+                    f"{self.base_url}/transcribe",
+                    data=data
+                ) as response:
+                    if response.status == 200:
+                        result = await response.json()
+                        return result.get('text', '').strip()
+                    else:
+                        logger.error(f"Whisper error: {response.status}")
+                        return None
+                        
         except Exception as e:
             logger.error(f"Whisper remote error: {e}")
             return None
     
     async def _transcribe_local(self, audio_path: str) -> Optional[str]:
         """Transcreve usando modelo local"""
-        if not self.local_model:
+        await self._ensure_model()
+        if not self._pool:
             logger.error("Modelo local não disponível")
             return None
             
         try:
-            # Executar em thread separada para não bloquear
+            # Executar em outro processo: áudios simultâneos não disputam o GIL
             loop = asyncio.get_event_loop()
-            result = await loop.run_in_executor(
-                None, 
-                lambda: self.local_model.transcribe(audio_path, language='en')
-            )
-            return result.get('text', '').strip()
+            return await loop.run_in_executor(self._pool, _worker_transcribe, audio_path)
+        except BrokenProcessPool as e:
+            # Worker morreu (ex.: falha ao carregar o modelo): não tentar de novo a cada áudio
+            self._local_enabled = False
+            if self._pool:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+            logger.error(f"Whisper local indisponível: {e}")
+            return None
         except Exception as e:
             logger.error(f"Whisper local error: {e}")
             return None
@@ -9,11 +9,52 @@ Uso: python migrate_database.py
 
 import os
 import sqlite3
-import json
+import orjson
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 
+# Cópia das mensagens de um chat do banco antigo (main) para o banco novo anexado (chat)
+_MSG_INSERT_SQL = """
+    INSERT INTO chat.messages (
+        chat_id, session_id, message_type, content, original_content,
+        is_voice, voice_duration, has_errors, grammar_corrections,
+        vocabulary_suggestions, confidence_score, response_time,
+        timestamp, message_context
+    )
+    SELECT
+        chat_id, session_id, message_type, content, original_content,
+        is_voice, voice_duration, has_errors, grammar_corrections,
+        vocabulary_suggestions, confidence_score, response_time,
+        timestamp, message_context
+    FROM main.messages 
+    WHERE chat_id = ? 
+    ORDER BY timestamp
+"""
+
+# metadata.json é lido por máquina: compacto por padrão, indentado com MIGRATION_PRETTY_JSON=1 (debug)
+_JSON_OPTIONS = orjson.OPT_INDENT_2 if os.getenv("MIGRATION_PRETTY_JSON") == "1" else 0
+
+# Limite padrão de bancos anexados a uma conexão do SQLite
+_MAX_ATTACHED = 10
+
+def _tune(conn, schema="main"):
+    """PRAGMAs de escrita em lote para um banco novo (schema = nome do banco anexado)"""
+    conn.execute(f"PRAGMA {schema}.journal_mode=WAL")
+    conn.execute(f"PRAGMA {schema}.synchronous=NORMAL")
+    conn.execute(f"PRAGMA {schema}.cache_size=-65536")
+    conn.execute(f"PRAGMA {schema}.mmap_size=268435456")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    # Sem checagem de FOREIGN KEY por linha durante a carga (os dados já vêm consistentes do banco antigo)
+    conn.execute("PRAGMA foreign_keys=OFF")
+
+# Índices das mensagens, criados depois da carga: uma construção única em vez de manutenção linha a linha
+_MSG_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS chat.idx_msg_time ON messages(timestamp)",
+    "CREATE INDEX IF NOT EXISTS chat.idx_msg_session ON messages(session_id)",
+)
+
 class DatabaseMigrator:
     """Migra dados do sistema antigo para o novo sistema otimizado"""
     
@@ -37,14 +78,22 @@ class DatabaseMigrator:
         # Criar backup do banco antigo
         self._backup_old_database()
         
-        # Obter lista de chat_ids únicos
-        chat_ids = self._get_unique_chat_ids()
+        old_conn = sqlite3.connect(self.old_db_path)
+        try:
+            # Índice (chat_id, timestamp): cada chat vira uma leitura de intervalo já ordenada
+            old_conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_chat_ts ON messages(chat_id, timestamp)")
+            old_conn.execute("ANALYZE")
+            
+            # Obter lista de chat_ids únicos
+            chat_ids = self._get_unique_chat_ids(old_conn)
+        finally:
+            old_conn.close()
         print(f"👥 Encontrados {len(chat_ids)} usuários únicos")
         
-        # Migrar cada usuário
-        for i, chat_id in enumerate(chat_ids, 1):
-            print(f"📦 Migrando usuário {i}/{len(chat_ids)}: chat_{chat_id}")
-            self._migrate_user_data(chat_id)
+        # Migrar usuários em paralelo: cada chat grava em arquivos próprios
+        with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as executor:
+            for i, chat_id in enumerate(executor.map(self._migrate_user_data, chat_ids), 1):
+                print(f"📦 Usuário migrado {i}/{len(chat_ids)}: chat_{chat_id}")
         
         # Verificar integridade
         self._verify_migration()
@@ -65,75 +114,64 @@ class DatabaseMigrator:
         shutil.copy2(self.old_db_path, backup_path)
         print(f"✅ Backup criado: {backup_path}")
         
-    def _get_unique_chat_ids(self):
+    def _get_unique_chat_ids(self, old_conn):
         """Obtém lista de chat_ids únicos do banco antigo"""
-        conn = sqlite3.connect(self.old_db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT DISTINCT chat_id FROM messages WHERE chat_id IS NOT NULL")
-        chat_ids = [row[0] for row in cursor.fetchall()]
-        
-        conn.close()
-        return chat_ids
+        cursor = old_conn.execute("SELECT DISTINCT chat_id FROM messages WHERE chat_id IS NOT NULL")
+        return [row[0] for row in cursor.fetchall()]
         
     def _migrate_user_data(self, chat_id):
-        """Migra dados de um usuário específico"""
+        """Migra dados de um usuário específico (roda numa thread do pool)"""
         user_dir = os.path.join(self.new_base_path, f"chat_{chat_id}")
-        os.makedirs(user_dir, exist_ok=True)
-        
-        # Migrar mensagens e sessões
-        self._migrate_conversations(chat_id, user_dir)
+        Path(user_dir).mkdir(parents=True, exist_ok=True)
+        
+        # Conexão própria da thread ao banco antigo, somente leitura
+        old_conn = sqlite3.connect(
+            f"{Path(self.old_db_path).resolve().as_uri()}?mode=ro", uri=True, cached_statements=256
+        )
+        try:
+            # Migrar mensagens e sessões
+            total_messages = self._migrate_conversations(old_conn, chat_id, user_dir)
+        finally:
+            old_conn.close()
         
         # Criar perfil básico
         self._create_user_profile(chat_id, user_dir)
         
         # Criar metadata
-        self._create_metadata(chat_id, user_dir)
+        self._create_metadata(chat_id, user_dir, total_messages)
+        return chat_id
         
-    def _migrate_conversations(self, chat_id, user_dir):
-        """Migra mensagens e sessões para conversations.db"""
+    def _migrate_conversations(self, old_conn, chat_id, user_dir):
+        """Migra mensagens e sessões para conversations.db, retornando quantas mensagens foram copiadas"""
         conversations_db = os.path.join(user_dir, "conversations.db")
         
-        # Conectar aos bancos
-        old_conn = sqlite3.connect(self.old_db_path)
-        new_conn = sqlite3.connect(conversations_db)
-        
-        # Criar tabelas no novo banco
-        self._create_conversations_tables(new_conn)
+        # Anexar o banco novo à conexão do banco antigo (que é somente leitura, daí o mode=rwc)
+        old_conn.execute("ATTACH DATABASE ? AS chat", (f"{Path(conversations_db).resolve().as_uri()}?mode=rwc",))
         
-        # Migrar mensagens
-        old_cursor = old_conn.cursor()
-        new_cursor = new_conn.cursor()
-        
-        old_cursor.execute("""
-            SELECT * FROM messages 
-            WHERE chat_id = ? 
-            ORDER BY timestamp
-        """, (chat_id,))
-        
-        messages = old_cursor.fetchall()
-        
-        for message in messages:
-            # Adaptar estrutura se necessário
-            new_cursor.execute("""
-                INSERT INTO messages (
-                    chat_id, session_id, message_type, content, original_content,
-                    is_voice, voice_duration, has_errors, grammar_corrections,
-                    vocabulary_suggestions, confidence_score, response_time,
-                    timestamp, message_context
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, message[1:])  # Pular o ID original
-        
-        new_conn.commit()
-        old_conn.close()
-        new_conn.close()
+        # Sem fsync por escrita: a cópia inteira é gravada numa única transação
+        _tune(old_conn, "chat")
         
-    def _create_conversations_tables(self, conn):
-        """Cria tabelas no banco de conversas"""
+        # Criar tabelas no novo banco
+        self._create_conversations_tables(old_conn, "chat")
+        
+        # Migrar mensagens: a cópia acontece inteira dentro do SQLite
+        # (sem trazer as linhas para o Python) e num único BEGIN/COMMIT
+        old_conn.execute("BEGIN")
+        cursor = old_conn.execute(_MSG_INSERT_SQL, (chat_id,))
+        total = cursor.rowcount
+        for index_sql in _MSG_INDEXES:
+            old_conn.execute(index_sql)
+        
+        old_conn.commit()
+        old_conn.execute("DETACH DATABASE chat")
+        return total
+        
+    def _create_conversations_tables(self, conn, schema="main"):
+        """Cria tabelas no banco de conversas (schema = nome do banco anexado)"""
         cursor = conn.cursor()
         
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS messages (
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {schema}.messages (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 chat_id INTEGER,
                 session_id TEXT,
@@ -152,8 +190,8 @@ class DatabaseMigrator:
             )
         """)
         
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS conversation_sessions (
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {schema}.conversation_sessions (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 chat_id INTEGER,
                 session_id TEXT UNIQUE,
@@ -174,6 +212,7 @@ class DatabaseMigrator:
         """Cria banco de perfil do usuário"""
         profile_db = os.path.join(user_dir, "profile.db")
         conn = sqlite3.connect(profile_db)
+        _tune(conn)
         cursor = conn.cursor()
         
         # Criar tabelas de perfil
@@ -230,20 +269,10 @@ class DatabaseMigrator:
         conn.commit()
         conn.close()
         
-    def _create_metadata(self, chat_id, user_dir):
-        """Cria arquivo metadata.json"""
+    def _create_metadata(self, chat_id, user_dir, total_messages):
+        """Cria arquivo metadata.json (total_messages vem da cópia das conversas)"""
         metadata_file = os.path.join(user_dir, "metadata.json")
         
-        # Calcular estatísticas básicas
-        conversations_db = os.path.join(user_dir, "conversations.db")
-        conn = sqlite3.connect(conversations_db)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT COUNT(*) FROM messages WHERE chat_id = ?", (chat_id,))
-        total_messages = cursor.fetchone()[0]
-        
-        conn.close()
-        
         metadata = {
             "chat_id": chat_id,
             "last_update": datetime.now().isoformat() + "Z",
@@ -269,8 +298,7 @@ class DatabaseMigrator:
             }
         }
         
-        with open(metadata_file, 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, indent=2, ensure_ascii=False)
+        Path(metadata_file).write_bytes(orjson.dumps(metadata, option=_JSON_OPTIONS))
             
     def _verify_migration(self):
         """Verifica integridade da migração"""
@@ -283,17 +311,30 @@ class DatabaseMigrator:
         old_count = old_cursor.fetchone()[0]
         old_conn.close()
         
-        # Contar mensagens nos bancos novos
-        new_count = 0
-        for chat_dir in os.listdir(self.new_base_path):
-            if chat_dir.startswith("chat_"):
-                conversations_db = os.path.join(self.new_base_path, chat_dir, "conversations.db")
+        # Bancos novos a conferir; scandir já traz o tipo de cada entrada, sem um stat extra por chat
+        databases = []
+        for entry in os.scandir(self.new_base_path):
+            if entry.name.startswith("chat_") and entry.is_dir(follow_symlinks=False):
+                conversations_db = os.path.join(entry.path, "conversations.db")
                 if os.path.exists(conversations_db):
-                    conn = sqlite3.connect(conversations_db)
-                    cursor = conn.cursor()
-                    cursor.execute("SELECT COUNT(*) FROM messages")
-                    new_count += cursor.fetchone()[0]
-                    conn.close()
+                    databases.append(conversations_db)
+        
+        # Contar mensagens nos bancos novos: grupos anexados a uma única conexão, uma consulta por grupo
+        new_count = 0
+        conn = sqlite3.connect(":memory:", uri=True)
+        try:
+            for start in range(0, len(databases), _MAX_ATTACHED):
+                group = databases[start:start + _MAX_ATTACHED]
+                for i, conversations_db in enumerate(group):
+                    conn.execute(
+                        f"ATTACH DATABASE ? AS c{i}", (f"{Path(conversations_db).resolve().as_uri()}?mode=ro",)
+                    )
+                counts = " UNION ALL ".join(f"SELECT COUNT(*) AS c FROM c{i}.messages" for i in range(len(group)))
+                new_count += conn.execute(f"SELECT SUM(c) FROM ({counts})").fetchone()[0]
+                for i in range(len(group)):
+                    conn.execute(f"DETACH DATABASE c{i}")
+        finally:
+            conn.close()
         
         print(f"📊 Mensagens no banco antigo: {old_count}")
         print(f"📊 Mensagens nos bancos novos: {new_count}")
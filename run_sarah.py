@@ -51,38 +51,44 @@ def check_environment():
     
     return True
 
-def check_services():
-    """Verifica se os serviços externos estão funcionando"""
+async def _probe(session, url):
+    """Retorna o status HTTP do serviço, ou None se não houver resposta"""
+    try:
+        async with session.get(url) as response:
+            return response.status
+    except Exception:
+        return None
+
+async def check_services():
+    """Verifica se os serviços externos estão funcionando (sondas em paralelo)"""
+    import aiohttp
     
     print(f"\n🔧 VERIFICANDO SERVIÇOS...")
     print("-" * 30)
     
+    use_gpt4all = os.getenv('USE_GPT4ALL', 'false').lower() == 'true'
+    
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=3)) as session:
+        probes = [_probe(session, 'http://localhost:5001/health')]
+        if use_gpt4all:
+            probes.append(_probe(session, 'http://localhost:4891/v1/models'))
+        statuses = await asyncio.gather(*probes)
+    
     # Verificar Whisper
-    try:
-        import requests
-        whisper_response = requests.get('http://localhost:5001/health', timeout=3)
-        if whisper_response.status_code == 200:
-            print("✅ Whisper API: Funcionando")
-        else:
-            print("⚠️ Whisper API: Não está rodando")
-            print("💡 Execute: cd whisper && python app.py")
-    except:
+    if statuses[0] == 200:
+        print("✅ Whisper API: Funcionando")
+    else:
         print("⚠️ Whisper API: Não está rodando")
         print("💡 Execute: cd whisper && python app.py")
     
     # Verificar GPT4All (se habilitado)
-    use_gpt4all = os.getenv('USE_GPT4ALL', 'false').lower() == 'true'
     if use_gpt4all:
-        try:
-            import requests
-            gpt4all_response = requests.get('http://localhost:4891/v1/models', timeout=3)
-            if gpt4all_response.status_code == 200:
-                print("✅ GPT4All Local: Funcionando")
-            else:
-                print("⚠️ GPT4All Local: Não está rodando")
-        except:
+        if statuses[1] == 200:
+            print("✅ GPT4All Local: Funcionando")
+        else:
             print("⚠️ GPT4All Local: Não está rodando")
-            print("💡 Inicie o GPT4All Server primeiro")
+            if statuses[1] is None:
+                print("💡 Inicie o GPT4All Server primeiro")
 
 def start_bot():
     """Inicia o bot Sarah"""
@@ -131,8 +137,11 @@ if __name__ == "__main__":
     if not check_environment():
         sys.exit(1)
     
-    # Verificar serviços
-    check_services()
+    # Verificar serviços num loop que continua instalado: asyncio.run() removeria o loop
+    # atual ao terminar e o run_polling() do bot (asyncio.get_event_loop()) falharia
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(check_services())
     
     # Iniciar bot
     try:
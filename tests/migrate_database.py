@@ -7,6 +7,7 @@ Migra dados do banco único para bancos individuais por chat_id
 import os
 import sqlite3
 import json
+import orjson
 import logging
 from pathlib import Path
 from datetime import datetime
@@ -16,6 +17,19 @@ import shutil
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# metadata.json é lido por máquina: compacto por padrão, indentado com MIGRATION_PRETTY_JSON=1 (debug)
+_JSON_OPTIONS = orjson.OPT_INDENT_2 if os.getenv("MIGRATION_PRETTY_JSON") == "1" else 0
+
+def _tune(conn):
+    """PRAGMAs de escrita em lote para os bancos novos"""
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA cache_size=-65536")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    # Sem checagem de FOREIGN KEY por linha durante a carga (os dados já vêm consistentes do banco antigo)
+    conn.execute("PRAGMA foreign_keys=OFF")
+
 def migrate_to_optimized_system():
     """Migra do sistema antigo para o novo sistema otimizado"""
     
@@ -70,6 +84,8 @@ def migrate_user_data(old_conn, chat_id, chat_path):
     profile_db = chat_path / "profile.db"
     
     with sqlite3.connect(profile_db) as new_conn:
+        _tune(new_conn)
+        
         # Criar tabelas
         new_conn.execute("""
             CREATE TABLE IF NOT EXISTS user_profile (
@@ -161,6 +177,9 @@ def migrate_conversations(old_conn, chat_id, chat_path):
     conversations_db = chat_path / "conversations.db"
     
     with sqlite3.connect(conversations_db) as new_conn:
+        # Sem fsync por escrita: a cópia inteira é gravada numa única transação
+        _tune(new_conn)
+        
         new_conn.execute("""
             CREATE TABLE IF NOT EXISTS messages (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -190,17 +209,23 @@ def migrate_conversations(old_conn, chat_id, chat_path):
         
         current_session = f"session_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
         
-        for conv in conversations:
-            new_conn.execute("""
-                INSERT INTO messages 
-                (chat_id, session_id, message_type, content, original_content,
-                 is_voice, has_errors, grammar_corrections, timestamp)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
+        new_conn.executemany("""
+            INSERT INTO messages 
+            (chat_id, session_id, message_type, content, original_content,
+             is_voice, has_errors, grammar_corrections, timestamp)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (
+            (
                 chat_id, current_session, conv['message_type'], 
                 conv['content'], conv['content'], conv['is_voice'],
                 conv['has_errors'], conv['grammar_corrections'], conv['timestamp']
-            ))
+            )
+            for conv in conversations
+        ))
+        
+        # Índices só depois da carga: uma construção única em vez de manutenção linha a linha
+        new_conn.execute("CREATE INDEX IF NOT EXISTS idx_msg_time ON messages(timestamp)")
+        new_conn.execute("CREATE INDEX IF NOT EXISTS idx_msg_session ON messages(session_id)")
         
         new_conn.commit()
 
@@ -235,8 +260,7 @@ def create_metadata(old_conn, chat_id, chat_path):
         }
     }
     
-    with open(metadata_file, 'w', encoding='utf-8') as f:
-        json.dump(metadata, f, indent=2, ensure_ascii=False)
+    metadata_file.write_bytes(orjson.dumps(metadata, option=_JSON_OPTIONS))
 
 def clean_start():
     """Inicia sistema limpo removendo dados antigos"""
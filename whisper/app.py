@@ -1,56 +1,190 @@
-from flask import Flask, request, jsonify
-import whisper
-import tempfile
+from flask import Flask, Request, request
+from werkzeug.exceptions import RequestEntityTooLarge
+from faster_whisper import WhisperModel, decode_audio
 import os
+import tempfile
+import orjson
+import numpy as np
+import hashlib
+import threading
 import logging
+import logging.handlers
+import queue
+import atexit
+from collections import OrderedDict
+
+# Uploads acima do limite em memória do werkzeug (500 KB) vão para um arquivo temporário:
+# em tmpfs quando disponível, sem escrita em disco antes da decodificação
+UPLOAD_TMPDIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if total_content_length is not None and total_content_length <= 500 * 1024:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        return tempfile.TemporaryFile("rb+", dir=UPLOAD_TMPDIR)
 
 app = Flask(__name__)
-logging.basicConfig(level=logging.INFO)
+app.request_class = UploadRequest
+# Limite do upload: o werkzeug para de ler o corpo ao passar daqui
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv("MAX_UPLOAD_MB", "25")) * 1024 * 1024
+# Logs escritos por uma thread própria: as threads das requisições só enfileiram o registro
+# (já formatado pelo QueueHandler do basicConfig)
+_log_queue = queue.Queue(-1)
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+logging.basicConfig(level=logging.INFO, handlers=[logging.handlers.QueueHandler(_log_queue)])
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logger = logging.getLogger(__name__)
 
 # Carregar modelo Whisper
 MODEL_SIZE = os.getenv("WHISPER_MODEL", "base")
 DEVICE = os.getenv("DEVICE", "cpu")
+NUM_WORKERS = int(os.getenv("NUM_WORKERS", "1"))
+# CTranslate2: pesos int8 na CPU, float16 na GPU
+COMPUTE_TYPE = os.getenv("WHISPER_COMPUTE", "int8" if DEVICE == "cpu" else "float16")
 
-logger.info(f"Carregando modelo Whisper {MODEL_SIZE} em {DEVICE}...")
-model = whisper.load_model(MODEL_SIZE, device=DEVICE)
+logger.info("Carregando modelo Whisper %s em %s (%s)...", MODEL_SIZE, DEVICE, COMPUTE_TYPE)
+model = WhisperModel(
+    MODEL_SIZE,
+    device=DEVICE,
+    compute_type=COMPUTE_TYPE,
+    num_workers=NUM_WORKERS,
+    cpu_threads=int(os.getenv("OMP_NUM_THREADS", "4"))
+)
 logger.info("Modelo carregado com sucesso!")
 
+# Warmup: 3 s de silêncio pelo encoder e decoder (sem VAD, que descartaria tudo) para que a
+# alocação e a inicialização dos kernels não caiam na primeira requisição
+_segments, _ = model.transcribe(np.zeros(16000 * 3, dtype=np.float32), language='en', beam_size=1)
+list(_segments)
+logger.info("Warmup ok")
+
+# Uma transcrição por worker do CTranslate2 (NUM_WORKERS): requisições simultâneas rodam
+# em paralelo no modelo e as excedentes esperam aqui, com as outras threads recebendo uploads
+model_slots = threading.BoundedSemaphore(NUM_WORKERS)
+
+# Transcrições recentes por hash do áudio (reenvios do mesmo clipe não passam pelo modelo)
+CACHE_SIZE = 256
+_cache: "OrderedDict[str, bytes]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+def _hash_stream(stream) -> str:
+    """SHA-256 do upload lido em blocos; o stream volta ao início para a decodificação"""
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(1 << 20), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+# Decodificação gulosa, sem fallback de temperatura, sem prompt do segmento anterior e sem
+# timestamps (áudios curtos, menos passos do decoder)
+TRANSCRIBE_OPTIONS = dict(
+    language='en',
+    task='transcribe',
+    beam_size=1,
+    best_of=1,
+    temperature=0.0,
+    condition_on_previous_text=False,
+    without_timestamps=True,
+    # Silero VAD: trechos de silêncio (>= 500 ms) nem chegam ao encoder
+    vad_filter=True,
+    vad_parameters=dict(min_silence_duration_ms=500)
+)
+
+def _stream_segments(audio):
+    """Emite {"segments": [...], "language": ...} à medida que cada segmento é decodificado"""
+    yield b'{"segments":['
+    tail = {"language": None}
+    try:
+        # O slot do modelo fica preso só enquanto o modelo trabalha, nunca durante o envio:
+        # um cliente lento não bloqueia as outras requisições
+        with model_slots:
+            segments, info = model.transcribe(audio, **TRANSCRIBE_OPTIONS)
+        tail["language"] = info.language
+        first = True
+        while True:
+            with model_slots:
+                segment = next(segments, None)
+            if segment is None:
+                break
+            item = orjson.dumps({"text": segment.text, "start": segment.start, "end": segment.end})
+            yield item if first else b',' + item
+            first = False
+    except Exception as e:
+        # O status 200 já foi enviado: o erro vai no próprio documento, que sempre fecha
+        logger.error("Erro na transcrição (stream): %s", e)
+        tail["error"] = str(e)
+    yield b'],' + orjson.dumps(tail)[1:]
+
+def _json_response(body, status: int = 200):
+    """Resposta JSON serializada com orjson (body já pode vir em bytes, ex.: do cache)"""
+    if not isinstance(body, bytes):
+        body = orjson.dumps(body)
+    return app.response_class(body, status=status, mimetype="application/json")
+
 @app.route('/health', methods=['GET'])
 def health():
-    return jsonify({"status": "healthy", "model": MODEL_SIZE})
+    return _json_response({"status": "healthy", "model": MODEL_SIZE})
 
 @app.route('/transcribe', methods=['POST'])
 def transcribe():
+    # Rejeitar pelo Content-Length antes de receber qualquer byte do áudio
+    if request.content_length and request.content_length > app.config['MAX_CONTENT_LENGTH']:
+        return _json_response({"error": "Audio file too large"}, 413)
+    
+    audio_file = None
     try:
         if 'audio' not in request.files:
-            return jsonify({"error": "No audio file provided"}), 400
+            return _json_response({"error": "No audio file provided"}, 400)
         
         audio_file = request.files['audio']
+        # ?stream=1: segmentos enviados conforme são decodificados (áudios longos)
+        stream = request.args.get('stream') == '1'
         
-        # Salvar arquivo temporário
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.ogg') as tmp_file:
-            audio_file.save(tmp_file.name)
-            temp_path = tmp_file.name
+        if not stream:
+            key = _hash_stream(audio_file.stream)
+            with _cache_lock:
+                cached = _cache.get(key)
+                if cached:
+                    _cache.move_to_end(key)
+            if cached:
+                return _json_response(cached)
+        
+        # Decodificar o upload direto do stream para PCM 16 kHz em memória (sem arquivo
+        # temporário), fora do semáforo: a próxima requisição decodifica enquanto outra transcreve
+        audio = decode_audio(audio_file.stream)
+        
+        if stream:
+            return app.response_class(_stream_segments(audio), mimetype="application/json")
         
         # Transcrever
-        result = model.transcribe(
-            temp_path,
-            language='en',
-            task='transcribe'
-        )
-        
-        # Limpar arquivo temporário
-        os.unlink(temp_path)
-        
-        return jsonify({
-            "text": result["text"],
-            "language": result.get("language", "en")
+        with model_slots:
+            segments, info = model.transcribe(audio, **TRANSCRIBE_OPTIONS)
+            # segments é um gerador: a decodificação acontece enquanto é consumido
+            text = "".join(segment.text for segment in segments)
+        
+        result = orjson.dumps({
+            "text": text,
+            "language": info.language
         })
+        with _cache_lock:
+            _cache[key] = result
+            if len(_cache) > CACHE_SIZE:
+                _cache.popitem(last=False)
+        
+        return _json_response(result)
         
+    except RequestEntityTooLarge:
+        # Corpo sem Content-Length que passou do limite durante a leitura
+        return _json_response({"error": "Audio file too large"}, 413)
     except Exception as e:
-        logger.error(f"Erro na transcrição: {e}")
-        return jsonify({"error": str(e)}), 500
+        logger.error("Erro na transcrição: %s", e)
+        return _json_response({"error": str(e)}, 500)
+    finally:
+        # Liberar o upload (e o arquivo de spool em /dev/shm) mesmo quando a transcrição falha
+        if audio_file is not None:
+            audio_file.close()
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5001)
+    # Apenas desenvolvimento; no container o app roda no gunicorn (ver Dockerfile)
+    app.run(host='0.0.0.0', port=5001, threaded=True)